@@ -0,0 +1,307 @@
+"""
+Headless benchmarks for the Python bake kernels.
+
+Runs spherical_harmonics_rotation.py and
+vertex_visibility_baking_least_square_fit.py the way PythonRunner.RunFile
+does (the file is exec'd with ``__name__ == "main"`` and the inputs injected
+as globals), with ``clr_stub`` standing in for pythonnet, on synthetic probe
+sets and mesh-Laplacian-like sparse systems of several sizes. Every case runs
+in a process of its own, so that its peak memory can be read from the
+process' peak resident set size: it includes what tracemalloc doesn't see
+(SuperLU's factors, Numba's buffers), as well as the interpreter and the
+imported modules (``base_bytes``, measured before the case runs). tracemalloc's
+peak (Python and NumPy allocations) is kept as ``python_peak_bytes``.
+Throughput, peak memory and JIT compile time are written to a JSON baseline,
+later runs can be compared against it:
+
+    python bench_bake_kernels.py --output baseline.json
+    python bench_bake_kernels.py --compare baseline.json
+
+The comparison exits with a non-zero status when a case got slower or bigger
+than the baseline by more than ``--tolerance``.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import numpy as np
+import scipy
+from scipy import sparse
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_SCRIPTS_DIR = os.path.dirname(_HERE)
+sys.path[:0] = [os.path.join(_HERE, 'clr_stub'), _SCRIPTS_DIR]
+
+import System
+
+
+def run_script(name, inputs, verbose=False):
+    """
+    Executes a bake script like PythonRunner.RunFile and returns its scope.
+    """
+    path = os.path.join(_SCRIPTS_DIR, name)
+    scope = dict(inputs, __name__='main', __file__=path)
+    with open(path) as f:
+        source = f.read()
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        exec(source, scope)
+    return scope
+
+
+def probe_set(num_probes, band, seed=0):
+    # random SH coefficients with a dominant DC term, like lit probes
+    rng = np.random.default_rng(seed)
+    sh_coeffs = rng.standard_normal((num_probes, band * band)).astype(np.float32)
+    sh_coeffs[:, 0] += 2.0
+    return sh_coeffs
+
+
+def laplacian_system(num_rows, islands=4):
+    # disconnected islands of regular-grid Laplacians plus a mass term, close
+    # to the structure of the visibility fit on a scene made of several meshes
+    side = max(2, int(np.sqrt(num_rows / islands)))
+    T = sparse.diags([-1.0, 2.0, -1.0], [-1, 0, 1], shape=(side, side))
+    I = sparse.identity(side)
+    grid = sparse.kron(T, I) + sparse.kron(I, T) + 0.1 * sparse.identity(side * side)
+    return sparse.block_diag([grid] * islands).tocoo()
+
+
+def max_rss():
+    """
+    Peak resident set size of this process in bytes, None where the resource
+    module is missing.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, but bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def measure(func, repeat):
+    """
+    Returns (first run time, best of `repeat` further runs, tracemalloc peak).
+    """
+    start = time.perf_counter()
+    func()
+    first = time.perf_counter() - start
+
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return first, best, peak
+
+
+def bench_sh_rotation(num_probes, band, repeat, verbose):
+    sh_coeffs = System.Array.FromNumpy(probe_set(num_probes, band).reshape(-1))
+
+    # a full rotation of every probe, the incremental rebake would skip them
+    # all after the first run
+    inputs = {'_sh_band': band, '_sh_coeffs': sh_coeffs, '_sh_incremental': False}
+    first, best, peak = measure(lambda: run_script('spherical_harmonics_rotation.py', inputs, verbose), repeat)
+
+    # a rebake with unchanged probes, served by the incremental path
+    rebake_inputs = dict(inputs, _sh_incremental=True)
+    run_script('spherical_harmonics_rotation.py', rebake_inputs, verbose)
+    _, rebake_best, _ = measure(lambda: run_script('spherical_harmonics_rotation.py', rebake_inputs, verbose), repeat)
+
+    return {
+        'items': num_probes,
+        'first_run_s': first,
+        'best_run_s': best,
+        'rebake_s': rebake_best,
+        'throughput': num_probes / best,
+        'python_peak_bytes': peak,
+    }
+
+
+def bench_least_square(num_rows, dim, repeat, verbose, ordering='COLAMD'):
+    import sparse_solver
+
+    A = laplacian_system(num_rows)
+    B = np.random.default_rng(0).standard_normal(A.shape[0] * dim)
+    inputs = {
+        '_data': System.Array.FromNumpy(A.data),
+        '_row': System.Array.FromNumpy(A.row.astype(np.int32)),
+        '_col': System.Array.FromNumpy(A.col.astype(np.int32)),
+        '_row_size': A.shape[0],
+        '_col_size': A.shape[1],
+        '_B': System.Array.FromNumpy(B),
+        '_dim': dim,
+        '_solver_ordering': ordering,
+    }
+
+    # a full solve, factorization included
+    def solve():
+        sparse_solver.factorization_cache.clear()
+        run_script('vertex_visibility_baking_least_square_fit.py', inputs, verbose)
+    first, best, peak = measure(solve, repeat)
+
+    # a rebake with an unchanged matrix, served by the factorization cache
+    rebake = lambda: run_script('vertex_visibility_baking_least_square_fit.py', inputs, verbose)
+    _, rebake_best, _ = measure(rebake, repeat)
+
+    return {
+        'items': A.shape[0],
+        'nnz': A.nnz,
+        'first_run_s': first,
+        'best_run_s': best,
+        'rebake_s': rebake_best,
+        'throughput': A.shape[0] / best,
+        'python_peak_bytes': peak,
+    }
+
+
+def run_case(case, args):
+    """
+    Runs one case in this process, `case` being ``[kind, size, band or dim]``,
+    and adds its peak memory to the results.
+    """
+    kind, size, parameter = case
+    base = max_rss()
+    if kind == 'sh_rotation':
+        result = bench_sh_rotation(size, parameter, args.repeat, args.verbose)
+    else:
+        result = bench_least_square(size, parameter, args.repeat, args.verbose, args.ordering)
+    peak = max_rss()
+    result['base_bytes'] = base
+    # tracemalloc's peak where the process' one isn't available
+    result['peak_bytes'] = peak if peak is not None else result['python_peak_bytes']
+    return result
+
+
+def run_case_process(case, args):
+    # a fresh process per case: its peak RSS is the case's alone, and the
+    # Numba cache (NUMBA_CACHE_DIR) is shared through the environment
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, 'case.json')
+        command = [sys.executable, os.path.abspath(__file__), '--case', json.dumps(case), '--case-output', output,
+                   '--repeat', str(args.repeat), '--ordering', args.ordering]
+        if args.verbose:
+            command.append('--verbose')
+        subprocess.run(command, check=True)
+        with open(output) as f:
+            return json.load(f)
+
+
+def run_benchmarks(args):
+    cases = {}
+    compile_time = None
+    for band in args.bands:
+        for num_probes in args.sh_sizes:
+            name = f'sh_rotation/band{band}/{num_probes}'
+            cases[name] = run_case_process(['sh_rotation', num_probes, band], args)
+            if compile_time is None:
+                # the first run imports and compiles the kernels
+                compile_time = cases[name]['first_run_s'] - cases[name]['best_run_s']
+            print_case(name, cases[name])
+
+    for num_rows in args.lsq_sizes:
+        name = f'least_square/dim{args.dim}/{num_rows}'
+        cases[name] = run_case_process(['least_square', num_rows, args.dim], args)
+        print_case(name, cases[name])
+
+    return {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'numba_cache_dir': os.environ.get('NUMBA_CACHE_DIR'),
+        'compile_s': compile_time,
+        'cases': cases,
+    }
+
+
+def print_case(name, case):
+    print('{:40} {:12.0f} items/s {:9.3f} s  peak {:8.1f} MiB'.format(
+        name, case['throughput'], case['best_run_s'], case['peak_bytes'] / 2**20))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the relative change of every case against the baseline and returns
+    the names of the cases that regressed by more than `tolerance`.
+    """
+    regressions = []
+    print('{:40} {:>12} {:>12}'.format('case', 'throughput', 'peak mem'))
+    for name, case in results['cases'].items():
+        reference = baseline['cases'].get(name)
+        if reference is None:
+            print('{:40} {:>12} {:>12}'.format(name, 'new', 'new'))
+            continue
+        throughput = case['throughput'] / reference['throughput'] - 1.0
+        memory = case['peak_bytes'] / max(reference['peak_bytes'], 1) - 1.0
+        regressed = throughput < -tolerance or memory > tolerance
+        print('{:40} {:>+11.1%} {:>+11.1%}{}'.format(name, throughput, memory, '  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(name)
+
+    if baseline.get('compile_s') and results.get('compile_s'):
+        print('compile time {:.3f} s (baseline {:.3f} s)'.format(results['compile_s'], baseline['compile_s']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bands', type=int, nargs='+', default=[3])
+    parser.add_argument('--sh-sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--lsq-sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--dim', type=int, default=4, help='visibility dimensions per row')
+    parser.add_argument('--ordering', default='COLAMD', help="column ordering of the LU, see sparse_solver.ORDERINGS, or 'auto'")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='relative throughput drop / memory growth reported as a regression')
+    parser.add_argument('--verbose', action='store_true', help="show the bake scripts' output")
+    # internal: run a single case, see run_case_process
+    parser.add_argument('--case', type=json.loads, help=argparse.SUPPRESS)
+    parser.add_argument('--case-output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        result = run_case(args.case, args)
+        with open(args.case_output, 'w') as f:
+            json.dump(result, f)
+        return
+
+    # measure a cold start unless a Numba cache was explicitly requested
+    if 'NUMBA_CACHE_DIR' not in os.environ:
+        os.environ['NUMBA_CACHE_DIR'] = tempfile.mkdtemp(prefix='numba_cache_')
+
+    results = run_benchmarks(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
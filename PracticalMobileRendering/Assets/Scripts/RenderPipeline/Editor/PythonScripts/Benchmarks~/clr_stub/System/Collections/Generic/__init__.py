@@ -0,0 +1,50 @@
+import numpy as np
+
+import System
+
+
+class _GenericTypeDefinition(object):
+    def __init__(self, fullName):
+        self.FullName = fullName
+
+
+class _Field(object):
+    def __init__(self, name):
+        self._name = name
+
+    def GetValue(self, target):
+        return getattr(target, self._name)
+
+
+class _ListType(object):
+    IsArray = False
+    IsGenericType = True
+    FullName = 'System.Collections.Generic.List`1'
+
+    def __init__(self, elementType):
+        self._elementType = elementType
+
+    def GetGenericTypeDefinition(self):
+        return _GenericTypeDefinition(self.FullName)
+
+    def GetGenericArguments(self):
+        return [self._elementType]
+
+    def GetField(self, name, bindingFlags):
+        return _Field(name)
+
+
+class List(object):
+    """
+    List<T> over a backing array with spare capacity, like the real one.
+    """
+    def __init__(self, npArray):
+        npArray = np.asarray(npArray)
+        capacity = max(4, 1 << int(len(npArray)).bit_length())
+        backing = np.zeros(capacity, dtype=npArray.dtype)
+        backing[:len(npArray)] = npArray
+        self._items = System.Array.FromNumpy(backing)
+        self.Count = len(npArray)
+
+    def GetType(self):
+        return _ListType(self._items.GetType().GetElementType())
@@ -0,0 +1,3 @@
+class BindingFlags(object):
+    Instance = 4
+    NonPublic = 32
@@ -0,0 +1,26 @@
+class GCHandleType(object):
+    Pinned = 3
+
+
+class _IntPtr(object):
+    def __init__(self, value):
+        self._value = value
+
+    def ToInt64(self):
+        return self._value
+
+
+class GCHandle(object):
+    def __init__(self, target):
+        self._target = target
+        self.IsAllocated = True
+
+    @staticmethod
+    def Alloc(target, handleType):
+        return GCHandle(target)
+
+    def AddrOfPinnedObject(self):
+        return _IntPtr(self._target._buffer.__array_interface__['data'][0])
+
+    def Free(self):
+        self.IsAllocated = False
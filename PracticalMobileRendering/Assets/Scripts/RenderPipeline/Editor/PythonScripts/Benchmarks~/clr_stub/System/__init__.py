@@ -0,0 +1,92 @@
+"""
+Minimal stand-in for the parts of the .NET ``System`` namespace the bake
+scripts and clr_array_convert use, so they can run outside of Unity. Arrays
+are backed by NumPy buffers and pinning hands out the buffer address.
+"""
+import numpy as np
+
+
+class _PrimitiveType(object):
+    IsArray = False
+    IsGenericType = False
+
+    def __init__(self, name, dtype):
+        self.Name = name
+        self.FullName = 'System.' + name
+        self.dtype = np.dtype(dtype)
+
+
+Single  = _PrimitiveType('Single', np.float32)
+Double  = _PrimitiveType('Double', np.float64)
+SByte   = _PrimitiveType('SByte', np.int8)
+Int16   = _PrimitiveType('Int16', np.int16)
+Int32   = _PrimitiveType('Int32', np.int32)
+Int64   = _PrimitiveType('Int64', np.int64)
+Byte    = _PrimitiveType('Byte', np.uint8)
+UInt16  = _PrimitiveType('UInt16', np.uint16)
+UInt32  = _PrimitiveType('UInt32', np.uint32)
+UInt64  = _PrimitiveType('UInt64', np.uint64)
+Boolean = _PrimitiveType('Boolean', np.bool_)
+
+_PRIMITIVE_TYPES = {t.dtype: t for t in (Single, Double, SByte, Int16, Int32, Int64,
+                                         Byte, UInt16, UInt32, UInt64, Boolean)}
+
+
+class _ArrayType(object):
+    IsArray = True
+    IsGenericType = False
+
+    def __init__(self, elementType):
+        self._elementType = elementType
+        self.Name = elementType.Name + '[]'
+        self.FullName = elementType.FullName + '[]'
+
+    def GetElementType(self):
+        return self._elementType
+
+
+class Array(object):
+    def __init__(self, elementType, dims):
+        self._elementType = elementType
+        if elementType.IsArray:
+            self._buffer = np.empty(dims, dtype=object)
+        else:
+            self._buffer = np.zeros(dims, dtype=elementType.dtype)
+
+    @staticmethod
+    def CreateInstance(elementType, *dims):
+        return Array(elementType, dims)
+
+    @property
+    def Rank(self):
+        return self._buffer.ndim
+
+    @property
+    def Length(self):
+        return self._buffer.size
+
+    def GetLength(self, dimension):
+        return self._buffer.shape[dimension]
+
+    def GetType(self):
+        return _ArrayType(self._elementType)
+
+    def __getitem__(self, index):
+        return self._buffer.reshape(-1)[index]
+
+    def __len__(self):
+        return self._buffer.size
+
+    @staticmethod
+    def FromNumpy(npArray):
+        netArray = Array(_PRIMITIVE_TYPES[npArray.dtype], npArray.shape)
+        netArray._buffer[...] = npArray
+        return netArray
+
+    @staticmethod
+    def Jagged(rows):
+        netRows = [Array.FromNumpy(np.asarray(row)) for row in rows]
+        netArray = Array(netRows[0].GetType(), (len(netRows),))
+        for i, netRow in enumerate(netRows):
+            netArray._buffer[i] = netRow
+        return netArray
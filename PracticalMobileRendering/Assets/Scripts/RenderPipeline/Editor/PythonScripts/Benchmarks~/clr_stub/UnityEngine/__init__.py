@@ -0,0 +1,7 @@
+class Debug(object):
+    @staticmethod
+    def Log(message):
+        print(message)
+
+    LogWarning = Log
+    LogError = Log
@@ -0,0 +1,7 @@
+"""
+Stand-in for pythonnet's ``clr`` module, see the ``System`` package next to it.
+"""
+
+
+def AddReference(name):
+    pass
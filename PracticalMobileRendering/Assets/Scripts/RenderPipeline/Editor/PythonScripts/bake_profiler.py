@@ -0,0 +1,154 @@
+"""
+Opt-in stage profiler for the bake scripts.
+
+Stages are timed with ``profiler.stage(name)`` blocks, which cost a single
+attribute check while profiling is off. It is turned on by setting the
+``BAKE_PROFILE`` environment variable, or by the ``_profile`` global of a bake
+script. A bake run inside ``profiler.session()`` then prints a summary table
+and writes a Chrome trace (open it in chrome://tracing or
+https://ui.perfetto.dev) when it ends.
+"""
+import functools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def _default_trace_path():
+    # Unity runs the scripts from the project root, keep the trace out of Assets
+    folder = "Library" if os.path.isdir("Library") else "."
+    return os.path.join(folder, "bake_profile_trace.json")
+
+
+class Profiler(object):
+    """
+    Cumulative per-stage timings and call counts, plus the raw events for the
+    Chrome trace. This module stays alive between bakes, call reset() before
+    profiling a new one.
+    """
+    def __init__(self):
+        self.enabled = os.environ.get("BAKE_PROFILE", "0") not in ("", "0")
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.stats = OrderedDict()  # stage -> [calls, total seconds]
+        self.threads = OrderedDict()  # parallel loop -> items run by each thread
+        self.events = []
+        self._origin = time.perf_counter()
+
+    @contextmanager
+    def session(self, enable=False, trace_path=None):
+        """
+        Profiles the enclosed bake if `enable` is set or profiling is already
+        on, and reports it at the end.
+        """
+        was_enabled = self.enabled
+        self.enabled = was_enabled or bool(enable)
+        self.reset()
+        try:
+            yield self
+        finally:
+            self.report(trace_path)
+            self.enabled = was_enabled
+
+    @contextmanager
+    def stage(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+
+        # a stage re-entered by recursion (asNetArray converting through
+        # itself) is only counted once
+        active = self._local.__dict__.setdefault("active", set())
+        if name in active:
+            yield
+            return
+
+        active.add(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            active.discard(name)
+            self.record(name, start, time.perf_counter(), args)
+
+    def timed(self, name):
+        """
+        Decorator timing every call of the function as the stage `name`.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name, start, end, args=None):
+        stat = self.stats.setdefault(name, [0, 0.0])
+        stat[0] += 1
+        stat[1] += end - start
+        self.events.append({
+            "name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+            "ts": (start - self._origin) * 1e6, "dur": (end - start) * 1e6,
+            "args": args or {},
+        })
+
+    def thread_utilization(self, name, thread_items):
+        """
+        Records how many items each worker thread of a parallel loop ran.
+        """
+        thread_items = np.asarray(thread_items)
+        total = self.threads.setdefault(name, np.zeros_like(thread_items))
+        total += thread_items
+        self.events.append({
+            "name": name + " items per thread", "ph": "C", "pid": os.getpid(),
+            "ts": (time.perf_counter() - self._origin) * 1e6,
+            "args": {"thread {}".format(i): int(n) for i, n in enumerate(thread_items)},
+        })
+
+    def summary(self):
+        lines = ["{:40} {:>8} {:>12} {:>12} {:>7}".format("stage", "calls", "total ms", "mean ms", "%")]
+        wall = max(time.perf_counter() - self._origin, 1e-9)
+        for name, (calls, total) in self.stats.items():
+            lines.append("{:40} {:8d} {:12.3f} {:12.3f} {:6.1f}%".format(
+                name, calls, total * 1e3, total * 1e3 / calls, 100.0 * total / wall))
+
+        for name, items in self.threads.items():
+            used = items[items > 0]
+            if used.size == 0:
+                continue
+            # balance is 1 when every busy thread ran the same number of items
+            lines.append("{}: {} of {} threads busy, items per thread min {} / max {}, balance {:.2f}".format(
+                name, used.size, items.size, used.min(), used.max(), used.mean() / used.max()))
+        return "\n".join(lines)
+
+    def write_chrome_trace(self, path):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+    def report(self, trace_path=None):
+        """
+        Prints the summary table and writes the Chrome trace, to
+        `trace_path`, ``BAKE_PROFILE_TRACE`` or Library/bake_profile_trace.json.
+        """
+        if not self.enabled:
+            return
+        trace_path = trace_path or os.environ.get("BAKE_PROFILE_TRACE") or _default_trace_path()
+        self.write_chrome_trace(trace_path)
+        print(self.summary())
+        print("chrome trace written to", os.path.abspath(trace_path))
+
+
+profiler = Profiler()
@@ -0,0 +1,204 @@
+"""
+Persistent bake worker, run out of the editor process:
+
+    python bake_worker.py
+
+bake_worker_client.BakeWorker starts it through PythonRunner.SpawnPythonProcess
+and keeps it alive between bakes, so the kernels are imported and compiled once
+and a long bake doesn't hold the editor's interpreter.
+
+Commands come in on stdin and replies go out on stdout, one JSON object per
+line. Arrays never go through the pipe: the client puts them in memory-mapped
+files (see `map_file`) and sends their descriptions,
+``{"path": path, "shape": [...], "dtype": "float32"}``; the worker maps them
+too, reads its inputs and writes its outputs in place.
+
+Commands, all but ``cancel`` and ``quit`` queued and run one at a time:
+
+    {"id": 1, "cmd": "warm_up", "bands": [3]}
+    {"id": 2, "cmd": "rotate_sh", "band": 3, "input": <array>, "output": <array>,
+     "dedup": false, "quantization": null}
+    {"id": 3, "cmd": "least_squares", "data": <array>, "row": <array>, "col": <array>,
+     "shape": [rows, cols], "B": <array>, "X": <array>, "mode": "auto", "tol": 1e-8,
+     "ordering": "COLAMD"}
+    {"cmd": "cancel", "id": 2}
+    {"cmd": "quit"}
+
+``B`` and ``X`` are stored dimension after dimension, ``(k, rows)`` and
+``(k, cols)``, like the bake script's ``_B`` and ``_X``.
+
+Replies: ``{"id": 2, "event": "progress", "done": 65536, "total": 100000}``,
+then one of ``done`` (with the elapsed ``time``), ``cancelled`` or ``error``
+(with a ``message``). A cancelled job stops at its next progress report, i.e.
+between chunks of probes or right hand sides.
+
+Anything the kernels print goes to stderr, which the client forwards to the
+console.
+"""
+import json
+import mmap
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+import numpy as np
+
+
+class Cancelled(Exception):
+    pass
+
+
+def map_file(path, size=None):
+    """
+    Maps the file at `path` in memory, after sizing it to `size` bytes if
+    given (by the client, which creates the files and deletes them).
+    """
+    with open(path, "r+b") as f:
+        if size is not None:
+            # an empty file can't be mapped
+            f.truncate(max(size, 1))
+        return mmap.mmap(f.fileno(), 0)
+
+
+class Worker(object):
+    def __init__(self, output):
+        self._output = output
+        self._output_lock = threading.Lock()
+        self._jobs = queue.Queue()
+        self._cancelled = set()
+        self._commands = {
+            "warm_up": self.warm_up,
+            "rotate_sh": self.rotate_sh,
+            "least_squares": self.least_squares,
+        }
+
+    def send(self, **message):
+        line = json.dumps(message)
+        with self._output_lock:
+            self._output.write(line + "\n")
+            self._output.flush()
+
+    def run(self, commands):
+        """
+        Reads `commands` (lines of JSON) until ``quit`` or the end of the
+        input, while the jobs run on a separate thread so that a cancel can
+        come in during a bake.
+        """
+        compute = threading.Thread(target=self._compute_loop, name="bake compute", daemon=True)
+        compute.start()
+        for line in commands:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                command = json.loads(line)
+            except ValueError:
+                self.send(event="error", message="malformed command {!r}".format(line))
+                continue
+
+            if command.get("cmd") == "quit":
+                break
+            if command.get("cmd") == "cancel":
+                self._cancelled.add(command.get("id"))
+            elif command.get("cmd") in self._commands:
+                self._jobs.put(command)
+            else:
+                self.send(id=command.get("id"), event="error",
+                          message="unknown command {!r}".format(command.get("cmd")))
+
+        # let the current job finish, drop the queued ones
+        while True:
+            try:
+                command = self._jobs.get_nowait()
+            except queue.Empty:
+                break
+            self.send(id=command.get("id"), event="cancelled")
+        self._jobs.put(None)
+        compute.join()
+
+    def _compute_loop(self):
+        while True:
+            command = self._jobs.get()
+            if command is None:
+                return
+            self._run(command)
+
+    def _run(self, command):
+        job_id = command.get("id")
+        segments = []
+        start = time.perf_counter()
+        try:
+            if job_id in self._cancelled:
+                raise Cancelled()
+
+            def progress(done, total):
+                self.send(id=job_id, event="progress", done=int(done), total=int(total))
+                if job_id in self._cancelled:
+                    raise Cancelled()
+
+            self._commands[command["cmd"]](command, segments, progress)
+            # unmapped before the client deletes the files, which Windows
+            # refuses while they are mapped
+            self._close(segments)
+            self.send(id=job_id, event="done", time=time.perf_counter() - start)
+        except Cancelled:
+            self.send(id=job_id, event="cancelled")
+        except Exception as e:
+            self.send(id=job_id, event="error", message="{}: {}".format(type(e).__name__, e),
+                      traceback=traceback.format_exc())
+        finally:
+            self._cancelled.discard(job_id)
+            self._close(segments)
+
+    @staticmethod
+    def _close(segments):
+        for mapping in segments:
+            try:
+                mapping.close()
+            except BufferError:
+                # a view outlived the job (kept by a cache), the mapping
+                # goes away with it
+                pass
+
+    @staticmethod
+    def _array(description, segments):
+        # view over a mapped file, closed by _run once the job is over
+        mapping = map_file(description["path"])
+        segments.append(mapping)
+        return np.ndarray(tuple(description["shape"]), dtype=np.dtype(description["dtype"]), buffer=mapping)
+
+    def warm_up(self, command, segments, progress):
+        import spherical_harmonics_rotation as kernels
+        print("warm up: {:.3f} s".format(kernels.warm_up(command.get("bands", (3,)))))
+
+    def rotate_sh(self, command, segments, progress):
+        import spherical_harmonics_rotation as kernels
+        sh_coeffs = self._array(command["input"], segments)
+        output = self._array(command["output"], segments)
+        output[...] = kernels.main_batched(sh_coeffs, command["band"], dedup=command.get("dedup", False),
+                                           quantization=command.get("quantization"), progress=progress)
+
+    def least_squares(self, command, segments, progress):
+        from sparse_solver import solve_system
+        data, row, col, B, X = (self._array(command[key], segments) for key in ("data", "row", "col", "B", "X"))
+        # the solver takes the dimensions as the columns of B
+        X.T[...] = solve_system(data, row, col, tuple(command["shape"]), B.T, mode=command.get("mode", "auto"),
+                                tol=command.get("tol", 1e-8), progress=progress,
+                                ordering=command.get("ordering", "COLAMD"))
+
+
+def main():
+    # the protocol owns the real stdout, prints from the kernels go to stderr
+    protocol = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8")
+    sys.stdout = sys.stderr
+
+    worker = Worker(protocol)
+    worker.send(event="ready", pid=os.getpid())
+    worker.run(sys.stdin)
+
+
+if __name__ == "__main__":
+    main()
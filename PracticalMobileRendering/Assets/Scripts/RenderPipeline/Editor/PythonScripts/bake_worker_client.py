@@ -0,0 +1,401 @@
+"""
+Editor side of bake_worker.py: runs the SH rotation and least-squares bakes in
+a persistent worker process instead of the editor's interpreter.
+
+    from bake_worker_client import bake_worker
+
+    job = bake_worker.rotate_sh(sh_coeffs, 3, on_progress=lambda done, total: ...)
+    ...
+    job.cancel()  # or
+    sh_coeffs_prime = job.result()
+
+The bake scripts hand their work to it when run with ``_use_worker`` set,
+see `deliver`.
+
+Inputs are copied once into memory-mapped files (under the project's Temp),
+which the worker maps too, reads in place and writes its results to; the
+result is copied out when the job is over and the files are deleted. Unlike
+multiprocessing.shared_memory, this doesn't involve multiprocessing's
+resource tracker, which would start a helper process through sys.executable:
+the Unity binary inside the editor. The worker is started on first use, through
+PythonRunner.SpawnPythonProcess inside the editor (a plain subprocess
+otherwise), and restarted if it died.
+"""
+import atexit
+import functools
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+
+from bake_worker import map_file
+
+_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bake_worker.py")
+
+# seconds a cancelled job gets to stop at its next progress report before the
+# worker is killed, e.g. when it is stuck in a factorization
+CANCEL_TIMEOUT = 5.0
+
+
+class BakeWorkerError(RuntimeError):
+    pass
+
+
+class BakeCancelled(Exception):
+    pass
+
+
+class _EditorProcess(object):
+    """
+    The worker as a System.Diagnostics.Process, read asynchronously so that
+    no thread of the editor blocks on its pipes.
+    """
+    def __init__(self, arguments, on_line, on_log):
+        from System.Collections.Generic import List
+        from UnityEditor.Scripting.Python import PythonRunner
+
+        net_arguments = List[str]()
+        for argument in arguments:
+            # SpawnProcess joins the arguments with spaces, quoting is up to us
+            net_arguments.Add('"{}"'.format(argument) if " " in argument else argument)
+        self._process = PythonRunner.SpawnPythonProcess(net_arguments, None, False, False, True, True)
+        if self._process is None:
+            raise BakeWorkerError("Could not start the bake worker")
+
+        # the handlers run on .NET thread pool threads, e.Data is None at the end of the stream
+        self._process.OutputDataReceived += lambda sender, e: on_line(e.Data)
+        self._process.ErrorDataReceived += lambda sender, e: e.Data is not None and on_log(e.Data)
+        self._process.BeginOutputReadLine()
+        self._process.BeginErrorReadLine()
+
+    def write_line(self, line):
+        self._process.StandardInput.WriteLine(line)
+        self._process.StandardInput.Flush()
+
+    def alive(self):
+        return not self._process.HasExited
+
+    def kill(self):
+        if not self._process.HasExited:
+            self._process.Kill()
+        self._process.Dispose()
+
+
+class _Subprocess(object):
+    """
+    The worker as a subprocess.Popen, for bakes run out of the editor.
+    """
+    def __init__(self, arguments, on_line, on_log):
+        self._process = subprocess.Popen([sys.executable] + arguments, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                         universal_newlines=True, bufsize=1)
+        for stream, callback in ((self._process.stdout, on_line), (self._process.stderr, on_log)):
+            threading.Thread(target=self._read, args=(stream, callback, callback is on_line), daemon=True).start()
+
+    @staticmethod
+    def _read(stream, callback, notify_end):
+        for line in stream:
+            callback(line.rstrip("\n"))
+        if notify_end:
+            callback(None)
+
+    def write_line(self, line):
+        self._process.stdin.write(line + "\n")
+        self._process.stdin.flush()
+
+    def alive(self):
+        return self._process.poll() is None
+
+    def kill(self):
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.wait()
+
+
+def _spawn(arguments, on_line, on_log):
+    try:
+        import UnityEditor.Scripting.Python
+    except ImportError:
+        return _Subprocess(arguments, on_line, on_log)
+    return _EditorProcess(arguments, on_line, on_log)
+
+
+def _shared_directory():
+    # the editor empties Temp when it quits, which also takes care of a file
+    # the worker still had mapped when it was deleted (Windows)
+    if os.path.isdir("Temp"):
+        directory = os.path.join("Temp", "BakeWorker")
+    else:
+        directory = os.path.join(tempfile.gettempdir(), "bake_worker")
+    os.makedirs(directory, exist_ok=True)
+    return os.path.abspath(directory)
+
+
+class _SharedArray(object):
+    """
+    A NumPy array in a memory-mapped file owned by this process.
+    """
+    def __init__(self, shape, dtype):
+        dtype = np.dtype(dtype)
+        handle, self.path = tempfile.mkstemp(prefix="bake_", suffix=".bin", dir=_shared_directory())
+        os.close(handle)
+        self._mapping = map_file(self.path, int(np.prod(shape)) * dtype.itemsize)
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self._mapping)
+
+    @classmethod
+    def copy_of(cls, array, dtype=None):
+        array = np.asarray(array, dtype=dtype)
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    def description(self):
+        return {"path": self.path, "shape": list(self.array.shape), "dtype": self.array.dtype.str}
+
+    def release(self):
+        self.array = None
+        try:
+            self._mapping.close()
+            os.remove(self.path)
+        except (BufferError, OSError):
+            # still mapped: a view outlived the job, or the worker was killed
+            # during it (Windows), Temp is emptied later on
+            pass
+
+
+def deliver(job, out=None, dtype=None, on_done=None):
+    """
+    Once `job` completes, writes its flattened result into the .NET array
+    `out` (converted to `dtype`) if given, then calls ``on_done(job)``, also
+    when the job failed or was cancelled. Both happen on the thread reading
+    the worker's output: `on_done` must hand anything touching Unity to the
+    main thread. Returns `job`.
+    """
+    def done(future):
+        if out is not None and not future.cancelled() and future.exception() is None:
+            from clr_array_convert import asNetArray
+            asNetArray(future.result().reshape(-1), dtype=dtype, out=out)
+        if on_done is not None:
+            on_done(job)
+    job.future.add_done_callback(done)
+    return job
+
+
+def _share(array, dtype=None, shape=None):
+    # .NET arrays are read in place, the only copy is the one into the file
+    if isinstance(array, np.ndarray):
+        return _SharedArray.copy_of(array if shape is None else array.reshape(shape), dtype)
+    from clr_array_convert import asNumpyView
+    with asNumpyView(array) as view:
+        return _SharedArray.copy_of(view if shape is None else view.reshape(shape), dtype)
+
+
+class BakeJob(object):
+    """
+    A bake submitted to the worker. `progress` holds the last ``(done, total)``
+    report; `on_progress` is called with it from the thread reading the
+    worker's output, not the main thread.
+    """
+    def __init__(self, worker, job_id, inputs, output, on_progress=None):
+        self.id = job_id
+        self.future = Future()
+        self.progress = (0, 0)
+        self._worker = worker
+        self._inputs = inputs
+        self._output = output
+        self._on_progress = on_progress
+        self._cancel_timer = None
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        """
+        The output array; raises BakeCancelled or BakeWorkerError if the job
+        didn't complete.
+        """
+        return self.future.result(timeout)
+
+    def cancel(self, timeout=CANCEL_TIMEOUT):
+        """
+        Asks the worker to stop the job, and kills it if that didn't happen
+        within `timeout` seconds. Doesn't wait.
+        """
+        if self.future.done():
+            return
+        self._worker._send({"cmd": "cancel", "id": self.id})
+        self._cancel_timer = threading.Timer(timeout, self._worker._cancel_timed_out, args=(self,))
+        self._cancel_timer.daemon = True
+        self._cancel_timer.start()
+
+    def _report(self, done, total):
+        self.progress = (done, total)
+        if self._on_progress is not None:
+            self._on_progress(done, total)
+
+    def _finish(self, error=None):
+        if self._cancel_timer is not None:
+            self._cancel_timer.cancel()
+        result = None
+        if error is None and self._output is not None:
+            result = np.array(self._output.array)
+        for shared in self._inputs + [self._output]:
+            if shared is not None:
+                shared.release()
+        self._inputs, self._output = [], None
+        if error is None:
+            self.future.set_result(result)
+        else:
+            self.future.set_exception(error)
+
+
+class BakeWorker(object):
+    def __init__(self, worker_script=_WORKER_SCRIPT):
+        self.worker_script = worker_script
+        self._process = None
+        self._generation = 0
+        self._lock = threading.RLock()
+        self._jobs = {}
+        self._ids = itertools.count(1)
+
+    def start(self, warm_up_bands=None):
+        """
+        Starts the worker if it isn't running, and optionally has it compile
+        the kernels of `warm_up_bands` ahead of the first bake.
+        """
+        with self._lock:
+            if self._process is None or not self._process.alive():
+                # the end of a killed worker's output must not fail the jobs of its replacement
+                self._generation += 1
+                self._process = _spawn(["-u", self.worker_script],
+                                       functools.partial(self._on_line, self._generation), self._on_log)
+        if warm_up_bands is not None:
+            bands = [int(band) for band in np.atleast_1d(warm_up_bands)]
+            return self._submit({"cmd": "warm_up", "bands": bands}, [], None)
+
+    def stop(self):
+        """
+        Kills the worker, failing its pending jobs.
+        """
+        with self._lock:
+            process, self._process = self._process, None
+        if process is not None:
+            try:
+                process.write_line(json.dumps({"cmd": "quit"}))
+            except Exception:
+                pass
+            process.kill()
+            self._fail_all(BakeWorkerError("The bake worker was stopped"))
+
+    def rotate_sh(self, sh_coeffs, sh_band, dedup=False, quantization=None, on_progress=None):
+        """
+        Rotates ``(num_probes, sh_band**2)`` (or flat) float32 coefficients,
+        see spherical_harmonics_rotation.main_batched. Returns a BakeJob whose
+        result has the shape ``(num_probes, sh_band**2)``.
+        """
+        source = _share(sh_coeffs, np.float32, (-1, sh_band * sh_band))
+        output = _SharedArray(source.array.shape, np.float32)
+        command = {"cmd": "rotate_sh", "band": int(sh_band), "input": source.description(),
+                   "output": output.description(), "dedup": bool(dedup), "quantization": quantization}
+        return self._submit(command, [source], output, on_progress)
+
+    def least_squares(self, data, row, col, shape, B, mode='auto', tol=1e-8, ordering='COLAMD', on_progress=None):
+        """
+        Solves ``A X = B`` for the COO matrix ``A = (data, (row, col))``, see
+        sparse_solver.solve_system. The right hand sides are laid out like
+        the bake script's ``_B``, dimension after dimension: ``(k, shape[0])``
+        or flat. Returns a BakeJob whose result has the shape
+        ``(k, shape[1])``, i.e. the layout of ``_X`` once flattened.
+        """
+        inputs = [_share(data), _share(row), _share(col), _share(B, np.float64, (-1, shape[0]))]
+        output = _SharedArray((inputs[3].array.shape[0], shape[1]), np.float64)
+        command = {"cmd": "least_squares", "shape": [int(shape[0]), int(shape[1])], "mode": mode, "tol": tol,
+                   "ordering": ordering, "X": output.description()}
+        command.update((key, shared.description()) for key, shared in zip(("data", "row", "col", "B"), inputs))
+        return self._submit(command, inputs, output, on_progress)
+
+    def _submit(self, command, inputs, output, on_progress=None):
+        self.start()
+        job = BakeJob(self, next(self._ids), inputs, output, on_progress)
+        command["id"] = job.id
+        with self._lock:
+            self._jobs[job.id] = job
+        try:
+            self._send(command)
+        except Exception as e:
+            self._take(job.id)._finish(BakeWorkerError("Could not send the job to the bake worker: {}".format(e)))
+        return job
+
+    def _send(self, command):
+        with self._lock:
+            if self._process is None:
+                raise BakeWorkerError("The bake worker isn't running")
+            self._process.write_line(json.dumps(command))
+
+    def _take(self, job_id):
+        with self._lock:
+            return self._jobs.pop(job_id, None)
+
+    def _on_line(self, generation, line):
+        if line is None:
+            if generation != self._generation:
+                return
+            # the worker exited or crashed
+            self._fail_all(BakeWorkerError("The bake worker exited"))
+            return
+        try:
+            message = json.loads(line)
+        except ValueError:
+            print("bake worker:", line)
+            return
+
+        event = message.get("event")
+        if event == "progress":
+            job = self._jobs.get(message.get("id"))
+            if job is not None:
+                job._report(message["done"], message["total"])
+            return
+        if event == "ready":
+            return
+
+        job = self._take(message.get("id"))
+        if job is None:
+            if event == "error":
+                print("bake worker:", message.get("message"))
+            return
+        if event == "done":
+            job._finish()
+        elif event == "cancelled":
+            job._finish(BakeCancelled())
+        else:
+            job._finish(BakeWorkerError("{}\n{}".format(message.get("message"), message.get("traceback", ""))))
+
+    def _on_log(self, line):
+        print("bake worker:", line)
+
+    def _cancel_timed_out(self, job):
+        if job.done():
+            return
+        print("bake worker: job {} didn't stop within the cancel timeout, restarting the worker".format(job.id))
+        # the other pending jobs are lost along with the process, which is
+        # gone by the time the cancelled job completes
+        job = self._take(job.id)
+        self.stop()
+        if job is not None:
+            job._finish(BakeCancelled())
+
+    def _fail_all(self, error):
+        with self._lock:
+            jobs, self._jobs = list(self._jobs.values()), {}
+        for job in jobs:
+            job._finish(error)
+
+
+bake_worker = BakeWorker()
+atexit.register(bake_worker.stop)
@@ -1,10 +1,14 @@
 import ctypes
+from contextlib import contextmanager
 
 import numpy as np
 
+from bake_profiler import profiler
+
 import clr 
 import System
 from System import Array, Int32
+from System.Reflection import BindingFlags
 from System.Runtime.InteropServices import GCHandle, GCHandleType
 
 _MAP_NP_NET = {
@@ -34,42 +38,164 @@ _MAP_NET_NP = {
     'Boolean': np.dtype(np.bool),
 }
 
+_LIST_TYPE = 'System.Collections.Generic.List`1'
+_NATIVE_ARRAY_TYPE = 'Unity.Collections.NativeArray`1'
+
+
+def _netArrayLayout(netArray: System.Array):
+    # shape and NumPy dtype of a .NET array
+    dims = tuple(netArray.GetLength(I) for I in range(netArray.Rank))
+    netType = netArray.GetType().GetElementType().Name
+    try:
+        return dims, _MAP_NET_NP[netType]
+    except KeyError:
+        raise NotImplementedError(f'asNumpyArray does support System type {netType}')
+
+
+def _netType(netObject):
+    if not hasattr(netObject, 'GetType'):
+        raise TypeError(f'Expected a .NET object, got {type(netObject).__name__}')
+    return netObject.GetType()
+
+
+def _isJagged(netObject):
+    netType = _netType(netObject)
+    return netType.IsArray and netType.GetElementType().IsArray
+
+
+def _contiguousNetArray(netObject):
+    # The .NET array holding the elements of `netObject` contiguously from
+    # index 0, and the shape of those elements. A List<T> is read from its
+    # backing array, a NativeArray<T> is bulk copied to a managed array.
+    netType = _netType(netObject)
+    if netType.IsArray and not netType.GetElementType().IsArray:
+        return netObject, _netArrayLayout(netObject)[0]
+    if netType.IsGenericType:
+        definition = netType.GetGenericTypeDefinition().FullName
+        if definition == _LIST_TYPE:
+            items = netType.GetField('_items', BindingFlags.NonPublic | BindingFlags.Instance).GetValue(netObject)
+            return items, (netObject.Count,)
+        if definition == _NATIVE_ARRAY_TYPE:
+            return netObject.ToArray(), (netObject.Length,)
+    raise TypeError(f'Cannot convert {netType.FullName} to a NumPy array, expected a .NET array, '
+                    f'a jagged array, a List<T> or a NativeArray<T>')
+
+
+def _memmoveFromNet(netArray: System.Array, npArray):
+    # copies the first npArray.nbytes bytes of netArray into npArray
+    sourceHandle = GCHandle.Alloc(netArray, GCHandleType.Pinned)
+    try: # Memmove 
+        sourcePtr = sourceHandle.AddrOfPinnedObject().ToInt64()
+        destPtr = npArray.__array_interface__['data'][0]
+        ctypes.memmove(destPtr, sourcePtr, npArray.nbytes)
+    finally:
+        if sourceHandle.IsAllocated: 
+            sourceHandle.Free()
+
+
+def _jaggedAsNumpyArray(netArray: System.Array):
+    # T[][] -> (rows, ...) array, one memmove per row
+    rows = [netArray[I] for I in range(netArray.Length)]
+    if not rows:
+        elementType = netArray.GetType().GetElementType().GetElementType().Name
+        return np.empty((0, 0), dtype=_MAP_NET_NP[elementType])
+
+    dims, dtype = _netArrayLayout(rows[0])
+    for row in rows:
+        if _netArrayLayout(row)[0] != dims:
+            raise ValueError('asNumpyArray only supports jagged arrays whose rows all have the same shape')
+
+    npArray = np.empty((len(rows),) + dims, order='C', dtype=dtype)
+    for I, row in enumerate(rows):
+        _memmoveFromNet(row, npArray[I])
+    return npArray
+
+
+@profiler.timed('asNumpyArray')
 def asNumpyArray(netArray: System.Array):
     """
     Converts a .NET array to a NumPy array. See `_MAP_NET_NP` for 
     the mapping of CLR types to Numpy ``dtype``.
 
+    Besides arrays, ``List<T>`` (read from its backing array), jagged
+    ``T[][]`` arrays with rows of equal shape (converted to a
+    ``(rows, ...)`` array) and ``NativeArray<T>`` are converted with bulk
+    copies. Anything else raises a ``TypeError`` rather than being iterated
+    element by element.
+
     Parameters
     ----------
-    netArray: System.Array
+    netArray: System.Array, List<T>, T[][] or NativeArray<T>
         The array to be converted
 
     Returns
     -------
     numpy.ndarray 
     """
-    dims = np.empty(netArray.Rank, dtype=int)
-    for I in range(netArray.Rank):
-        dims[I] = netArray.GetLength(I)
-    netType = netArray.GetType().GetElementType().Name
+    if _isJagged(netArray):
+        return _jaggedAsNumpyArray(netArray)
 
-    try:
-        npArray = np.empty(dims, order='C', dtype=_MAP_NET_NP[netType])
-    except KeyError:
-        raise NotImplementedError(f'asNumpyArray does support System type {netType}')
+    netArray, dims = _contiguousNetArray(netArray)
+    _, dtype = _netArrayLayout(netArray)
+    npArray = np.empty(dims, order='C', dtype=dtype)
+    _memmoveFromNet(netArray, npArray)
+    return npArray
 
-    try: # Memmove 
-        sourceHandle = GCHandle.Alloc(netArray, GCHandleType.Pinned)
-        sourcePtr = sourceHandle.AddrOfPinnedObject().ToInt64()
-        destPtr = npArray.__array_interface__['data'][0]
-        ctypes.memmove(destPtr, sourcePtr, npArray.nbytes)
+
+@contextmanager
+def asNumpyView(netArray: System.Array):
+    """
+    Exposes a .NET array as a NumPy array without copying it. The .NET
+    array is pinned for the duration of the ``with`` block and the view
+    reads and writes its memory directly.
+
+    A ``List<T>`` is viewed through its backing array. A ``NativeArray<T>``
+    is first bulk copied to a managed array, and a jagged ``T[][]`` array
+    isn't contiguous and is converted with `asNumpyArray`: in these two
+    cases writes to the view don't reach the original object.
+
+    Parameters
+    ----------
+    netArray: System.Array, List<T>, T[][] or NativeArray<T>
+        The array to be viewed
+
+    Yields
+    ------
+    numpy.ndarray
+
+    Warning
+    -------
+    The array is unpinned when the ``with`` block exits, after which the GC
+    is free to move it: the view (and any NumPy view derived from it) must
+    not be used or kept past the block. Copy what needs to outlive it.
+
+    Examples
+    --------
+    >>> with asNumpyView(_B) as B:
+    ...     x = solve(B)
+    """
+    if _isJagged(netArray):
+        yield _jaggedAsNumpyArray(netArray)
+        return
+
+    netArray, dims = _contiguousNetArray(netArray)
+    _, dtype = _netArrayLayout(netArray)
+    handle = GCHandle.Alloc(netArray, GCHandleType.Pinned)
+    try:
+        nbytes = int(np.prod(dims)) * dtype.itemsize
+        if nbytes == 0:
+            yield np.empty(dims, dtype=dtype)
+        else:
+            ptr = handle.AddrOfPinnedObject().ToInt64()
+            buffer = (ctypes.c_byte * nbytes).from_address(ptr)
+            yield np.frombuffer(buffer, dtype=dtype).reshape(dims)
     finally:
-        if sourceHandle.IsAllocated: 
-            sourceHandle.Free()
-    return npArray
+        if handle.IsAllocated:
+            handle.Free()
 
 
-def asNetArray(npArray):
+@profiler.timed('asNetArray')
+def asNetArray(npArray, dtype=None, out=None):
     """
     Converts a NumPy array to a .NET array. See `_MAP_NP_NET` for 
     the mapping of CLR types to Numpy ``dtype``.
@@ -78,10 +204,19 @@ def asNetArray(npArray):
     ----------
     npArray: numpy.ndarray
         The array to be converted
+    dtype: numpy.dtype, optional
+        Element type of the .NET array. The conversion is done while copying
+        into the .NET array, without a temporary NumPy array.
+    out: System.Array, optional
+        Existing .NET array to write the result into instead of allocating
+        a new one. It must have the same shape as ``npArray`` (or be 1-D with
+        the same number of elements), and ``npArray`` must be castable to
+        its element type with ``same_kind`` casting.
 
     Returns
     -------
     System.Array
+        ``out`` if it was given
 
     Warning
     -------
@@ -90,34 +225,48 @@ def asNetArray(npArray):
 
     """
     dims = npArray.shape
-    dtype = npArray.dtype
 
     # For complex arrays, we must make a view of the array as its corresponding 
     # float type as if it's (real, imag)
-    if dtype == np.complex64:
-        dtype = np.dtype(np.float32)
+    if npArray.dtype == np.complex64:
         dims += (2,)
-        npArray = npArray.view(dtype).reshape(dims)
-    elif dtype == np.complex128:
-        dtype = np.dtype(np.float64)
+        npArray = npArray.view(np.float32).reshape(dims)
+    elif npArray.dtype == np.complex128:
         dims += (2,)
-        npArray = npArray.view(dtype).reshape(dims)
+        npArray = npArray.view(np.float64).reshape(dims)
 
-    if not npArray.flags.c_contiguous or not npArray.flags.aligned:
-        npArray = np.ascontiguousarray(npArray)
-    assert npArray.flags.c_contiguous
+    if out is not None:
+        outDims, outDtype = _netArrayLayout(out)
+        if dtype is not None and np.dtype(dtype) != outDtype:
+            raise TypeError(f'asNetArray got dtype {np.dtype(dtype)} but out holds {outDtype}')
+        if dims != outDims and not (len(outDims) == 1 and npArray.size == outDims[0]):
+            raise ValueError(f'asNetArray cannot write an array of shape {dims} into an array of shape {outDims}')
+        if not np.can_cast(npArray.dtype, outDtype, casting='same_kind'):
+            raise TypeError(f'asNetArray cannot convert {npArray.dtype} to {outDtype}')
 
+        with asNumpyView(out) as outView:
+            np.copyto(outView, npArray.reshape(outDims), casting='same_kind')
+        return out
+
+    dtype = npArray.dtype if dtype is None else np.dtype(dtype)
     try:
         netArray = Array.CreateInstance(_MAP_NP_NET[dtype], *dims)
     except KeyError:
         raise NotImplementedError(f'asNetArray does not yet support dtype {dtype}')
 
+    if dtype != npArray.dtype:
+        return asNetArray(npArray, out=netArray)
+
+    if not npArray.flags.c_contiguous or not npArray.flags.aligned:
+        npArray = np.ascontiguousarray(npArray)
+    assert npArray.flags.c_contiguous
+
+    destHandle = GCHandle.Alloc(netArray, GCHandleType.Pinned)
     try: # Memmove 
-        destHandle = GCHandle.Alloc(netArray, GCHandleType.Pinned)
         sourcePtr = npArray.__array_interface__['data'][0]
         destPtr = destHandle.AddrOfPinnedObject().ToInt64()
         ctypes.memmove(destPtr, sourcePtr, npArray.nbytes)
     finally:
         if destHandle.IsAllocated: 
             destHandle.Free()
-    return netArray
\ No newline at end of file
+    return netArray
@@ -0,0 +1,583 @@
+import hashlib
+import inspect
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.sparse import coo_matrix, csgraph, diags, linalg
+
+# "auto" mode switches from LU to an iterative solver above this many rows,
+# where the fill-in of the direct factorization gets too large
+ITERATIVE_MIN_ROWS = 1000000
+
+# connected components of at most this many unknowns are solved with a dense
+# LU, batched by size, instead of each getting a SuperLU object
+DENSE_MAX_SIZE = 64
+
+# threads factorizing and solving the components, SuperLU releases the GIL
+SOLVE_THREADS = os.cpu_count() or 1
+
+# fill-reducing column orderings: SuperLU's permc_spec values, plus 'RCM', a
+# reverse Cuthill-McKee symmetric permutation of the matrix factorized without
+# further column ordering. 'auto' picks one with `select_ordering`.
+ORDERINGS = ('COLAMD', 'MMD_AT_PLUS_A', 'MMD_ATA', 'NATURAL', 'RCM')
+DEFAULT_ORDERING = 'COLAMD'
+
+# minimum degree on A^T + A only pays off if the pivots stay on the diagonal:
+# SuperLU's symmetric mode, which keeps a diagonal pivot unless it is below
+# this fraction of the largest entry of its column. With the default partial
+# pivoting its fill-in explodes on mesh-sized systems.
+SYMMETRIC_MODE_PIVOT_THRESHOLD = 0.01
+
+# unknowns of the subgraph the orderings are tried on in 'auto'
+ORDERING_SAMPLE_SIZE = 5000
+
+# scipy renamed cg's `tol` to `rtol` (1.12)
+_CG_TOL = 'rtol' if 'rtol' in inspect.signature(linalg.cg).parameters else 'tol'
+
+
+class FactorizationCache(object):
+    """
+    LRU cache of sparse LU factorizations, and of the warm starts of the
+    iterative solves, bounded by the memory they hold. This module is
+    imported by the bake scripts, so it (and the cache) stays alive between
+    bakes of the same editor session.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, lu, nbytes):
+        if key in self._entries:
+            # replaced, e.g. by a newer warm start
+            self.nbytes -= self._entries.pop(key)[1]
+        if nbytes > self.max_bytes:
+            return
+        self._entries[key] = (lu, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+factorization_cache = FactorizationCache(max_bytes=1 << 30)
+
+
+def matrix_key(data, row, col, shape):
+    """
+    Hashes a COO matrix: its shape, sparsity pattern and values.
+
+    Parameters
+    ----------
+    data, row, col: numpy.ndarray
+        COO triplets of the matrix
+    shape: tuple
+
+    Returns
+    -------
+    str
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.asarray(shape, dtype=np.int64).tobytes())
+    for array in (row, col, data):
+        array = np.ascontiguousarray(array)
+        digest.update(array.dtype.str.encode())
+        digest.update(memoryview(array).cast('B'))
+    return digest.hexdigest()
+
+
+_executor = None
+
+
+def _thread_pool():
+    # created on first use and kept, like the caches, for later bakes
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=SOLVE_THREADS, thread_name_prefix='sparse_solver')
+    return _executor
+
+
+class PermutedLU(object):
+    """
+    Factorization of ``A[perm][:, perm]``, solving systems of ``A``.
+    """
+    def __init__(self, lu, perm):
+        self.lu = lu
+        self.perm = perm
+        self.shape = lu.shape
+
+    def solve(self, B):
+        B = np.asarray(B)
+        X = np.empty(B.shape, dtype=np.result_type(B.dtype, np.float64), order='F')
+        X[self.perm] = self.lu.solve(np.asfortranarray(B[self.perm]))
+        return X
+
+
+def splu(A, ordering=DEFAULT_ORDERING):
+    """
+    Sparse LU factorization of the square matrix ``A``.
+
+    Parameters
+    ----------
+    A: scipy.sparse matrix
+    ordering: str
+        One of `ORDERINGS`
+
+    Returns
+    -------
+    scipy.sparse.linalg.SuperLU or PermutedLU
+    """
+    if ordering not in ORDERINGS:
+        raise ValueError(f'Unknown ordering {ordering}, expected one of {ORDERINGS}')
+    if ordering == 'RCM':
+        A = A.tocsr()
+        perm = csgraph.reverse_cuthill_mckee(A, symmetric_mode=False)
+        return PermutedLU(linalg.splu(A[perm][:, perm].tocsc(), permc_spec='NATURAL'), perm)
+    if ordering == 'MMD_AT_PLUS_A':
+        return linalg.splu(A.tocsc(), permc_spec=ordering, diag_pivot_thresh=SYMMETRIC_MODE_PIVOT_THRESHOLD,
+                           options=dict(SymmetricMode=True))
+    return linalg.splu(A.tocsc(), permc_spec=ordering)
+
+
+def lu_nnz(lu):
+    """
+    Nonzeros of L + U, all of them for the dense blocks of a BlockDiagonalLU.
+    """
+    if isinstance(lu, BlockDiagonalLU):
+        return (sum(lu_nnz(block) for _, block in lu.sparse_blocks)
+                + sum(blocks.size for _, blocks in lu.dense_groups))
+    if isinstance(lu, PermutedLU):
+        lu = lu.lu
+    return lu.L.nnz + lu.U.nnz
+
+
+def select_ordering(A, orderings=ORDERINGS, sample_size=None):
+    """
+    Factorizes a sample of ``A`` with each of `orderings` and picks the one
+    with the fewest nonzeros in L + U, the fill-in driving both the memory
+    and the time of the factorization and the solves. The sample is the
+    first `sample_size` (`ORDERING_SAMPLE_SIZE`) unknowns reached by a
+    breadth-first search, i.e. a connected patch of the mesh, or the whole
+    matrix if it is smaller. It keeps the order of ``A`` so that NATURAL is
+    judged on the order it would get.
+
+    Parameters
+    ----------
+    A: scipy.sparse matrix
+    orderings: sequence of str
+    sample_size: int or None
+
+    Returns
+    -------
+    str, list
+        The best ordering, and ``(ordering, nnz(L+U), factor seconds)`` for
+        every ordering that succeeded
+    """
+    sample_size = ORDERING_SAMPLE_SIZE if sample_size is None else sample_size
+    A = A.tocsr()
+    if A.shape[0] > sample_size:
+        nodes = csgraph.breadth_first_order(A, 0, directed=False, return_predecessors=False)[:sample_size]
+        nodes.sort()
+        A = A[nodes][:, nodes]
+
+    trials = []
+    for ordering in orderings:
+        start = time.perf_counter()
+        try:
+            lu = splu(A, ordering)
+        except RuntimeError:
+            # e.g. a sample singular without pivoting across the whole matrix
+            continue
+        trials.append((ordering, lu_nnz(lu), time.perf_counter() - start))
+    if not trials:
+        return DEFAULT_ORDERING, trials
+    return min(trials, key=lambda trial: (trial[1], trial[2]))[0], trials
+
+
+def _resolve_ordering(A, ordering):
+    if ordering != 'auto':
+        return ordering
+    ordering, trials = select_ordering(A)
+    print(f'ordering on a {min(A.shape[0], ORDERING_SAMPLE_SIZE)} unknowns sample: {ordering}')
+    for name, nnz, seconds in trials:
+        print(f'  {name:14} nnz(L+U) {nnz:10d}  factor {seconds:.3f} s')
+    return ordering
+
+
+def connected_components(A):
+    """
+    Groups the unknowns of the square matrix ``A`` by connected component of
+    its (symmetrized) graph: ``A`` is block diagonal in that order.
+
+    Parameters
+    ----------
+    A: scipy.sparse matrix
+
+    Returns
+    -------
+    numpy.ndarray, numpy.ndarray, numpy.ndarray
+        The component of every unknown, the unknowns sorted by component and
+        the offset of every component in that order (one more entry than
+        there are components)
+    """
+    num_components, labels = csgraph.connected_components(A, directed=False)
+    order = np.argsort(labels, kind='stable')
+    starts = np.zeros(num_components + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=num_components), out=starts[1:])
+    return labels, order, starts
+
+
+class BlockDiagonalLU(object):
+    """
+    LU factorization of a square matrix made of several independent blocks,
+    e.g. the disconnected meshes and islands of a scene: every block gets
+    its own, smaller, factorization, without the fill-in a single
+    factorization would create between them.
+
+    Parameters
+    ----------
+    shape: tuple
+    sparse_blocks: list
+        ``(indices, SuperLU)`` of the large components
+    dense_groups: list
+        ``(indices, inverses)`` of the small components, by size ``s``:
+        the ``(m, s)`` unknowns of ``m`` components and the inverses of
+        their ``(m, s, s)`` dense blocks, applied with a batched matmul
+    """
+    def __init__(self, shape, sparse_blocks, dense_groups):
+        self.shape = shape
+        self.sparse_blocks = sparse_blocks
+        self.dense_groups = dense_groups
+
+    @property
+    def num_components(self):
+        return len(self.sparse_blocks) + sum(indices.shape[0] for indices, _ in self.dense_groups)
+
+    @property
+    def nbytes(self):
+        return (sum(lu_nbytes(lu) + indices.nbytes for indices, lu in self.sparse_blocks)
+                + sum(indices.nbytes + inverses.nbytes for indices, inverses in self.dense_groups))
+
+    def solve(self, B):
+        """
+        Solves for every column of ``B`` (shape ``(n, k)`` or ``(n,)``).
+        """
+        B = np.asarray(B)
+        X = np.empty(B.shape, dtype=np.result_type(B.dtype, np.float64), order='F')
+
+        def solve_component(block):
+            indices, lu = block
+            X[indices] = lu.solve(np.asfortranarray(B[indices]))
+        list(_thread_pool().map(solve_component, self.sparse_blocks))
+
+        for indices, inverses in self.dense_groups:
+            # (m, s, k) right hand sides of the m components of size s
+            rhs = B[indices].reshape(indices.shape + (-1,))
+            X[indices] = np.matmul(inverses, rhs).reshape(X[indices].shape)
+        return X
+
+
+def factorize_blocks(A, dense_max_size=None, ordering=DEFAULT_ORDERING):
+    """
+    LU factorization of the square matrix ``A``, split along the connected
+    components of its graph when it has several (see `BlockDiagonalLU`).
+    The large components are factorized in parallel, the small ones
+    inverted once, here, so that a singular island is reported by the
+    factorization rather than by every solve.
+
+    Parameters
+    ----------
+    A: scipy.sparse matrix
+    dense_max_size: int or None
+        Defaults to `DENSE_MAX_SIZE`
+    ordering: str
+        One of `ORDERINGS`, or 'auto' to pick one on the largest component
+        with `select_ordering`
+
+    Returns
+    -------
+    scipy.sparse.linalg.SuperLU, PermutedLU or BlockDiagonalLU
+    """
+    dense_max_size = DENSE_MAX_SIZE if dense_max_size is None else dense_max_size
+    A = A.tocsr()
+    labels, order, starts = connected_components(A)
+    if len(starts) <= 2:
+        return splu(A, _resolve_ordering(A, ordering))
+
+    sizes = np.diff(starts)
+
+    large = np.flatnonzero(sizes > dense_max_size)
+    large_indices = [order[starts[c]:starts[c + 1]] for c in large]
+    if large_indices and ordering == 'auto':
+        largest = max(large_indices, key=len)
+        ordering = _resolve_ordering(A[largest][:, largest], ordering)
+    factors = _thread_pool().map(lambda indices: splu(A[indices][:, indices], ordering), large_indices)
+    sparse_blocks = list(zip(large_indices, factors))
+
+    dense_groups = []
+    small = sizes <= dense_max_size
+    if small.any():
+        # position of every unknown in its component, and of every component
+        # among the components of the same size
+        position = np.empty(A.shape[0], dtype=np.int64)
+        position[order] = np.arange(A.shape[0]) - np.repeat(starts[:-1], sizes)
+        slot = np.empty(len(sizes), dtype=np.int64)
+
+        coo = A.tocoo()
+        entry_size = sizes[labels[coo.row]]
+        for size in np.unique(sizes[small]):
+            components = np.flatnonzero(sizes == size)
+            slot[components] = np.arange(len(components))
+            indices = order[starts[components][:, None] + np.arange(size)]
+
+            entries = entry_size == size
+            row, col = coo.row[entries], coo.col[entries]
+            blocks = np.zeros((len(components), size, size), dtype=np.result_type(A.dtype, np.float64))
+            np.add.at(blocks, (slot[labels[row]], position[row], position[col]), coo.data[entries])
+            dense_groups.append((indices, _invert_blocks(blocks, indices)))
+
+    return BlockDiagonalLU(A.shape, sparse_blocks, dense_groups)
+
+
+def _invert_blocks(blocks, indices):
+    try:
+        return np.linalg.inv(blocks)
+    except np.linalg.LinAlgError:
+        # raised like splu does for a singular matrix, naming an unknown of
+        # every singular component
+        singular = [i for i, block in enumerate(blocks) if np.linalg.matrix_rank(block) < block.shape[0]]
+        raise RuntimeError("Factor is exactly singular: {:d} components of size {:d}, e.g. the ones of unknowns {}"
+                           .format(len(singular), blocks.shape[1], indices[singular[:8], 0].tolist()))
+
+
+def lu_nbytes(lu):
+    if isinstance(lu, BlockDiagonalLU):
+        return lu.nbytes
+    if isinstance(lu, PermutedLU):
+        return lu_nbytes(lu.lu) + lu.perm.nbytes
+    # values and row indices of L and U, plus the two permutations
+    return (lu.L.nnz + lu.U.nnz) * (np.dtype(lu.L.dtype).itemsize + 4) + 2 * lu.shape[0] * 4
+
+
+def factorize(data, row, col, shape, ordering=DEFAULT_ORDERING):
+    """
+    LU factorization of the COO matrix ``(data, (row, col))``. Factorizations
+    are cached by `matrix_key`, so rebaking with an unchanged matrix (e.g. the
+    same mesh with new lighting) only costs the triangular solves. The
+    connected components of the matrix are factorized separately, see
+    `factorize_blocks`.
+
+    Parameters
+    ----------
+    data, row, col: numpy.ndarray
+        COO triplets of the matrix
+    shape: tuple
+    ordering: str
+        See `factorize_blocks`
+
+    Returns
+    -------
+    scipy.sparse.linalg.SuperLU, PermutedLU or BlockDiagonalLU
+    """
+    key = f'{matrix_key(data, row, col, shape)}:{ordering}'
+    lu = factorization_cache.get(key)
+    if lu is None:
+        start = time.perf_counter()
+        lu = factorize_blocks(coo_matrix((data, (row, col)), shape=shape), ordering=ordering)
+        elapsed = time.perf_counter() - start
+
+        nnz = lu_nnz(lu)
+        components = f', {lu.num_components} components' if isinstance(lu, BlockDiagonalLU) else ''
+        print(f'LU ({ordering}) of {shape[0]}x{shape[1]}{components}: nnz(L+U) {nnz} '
+              f'({nnz / max(len(data), 1):.1f}x nnz(A)), factor {elapsed:.3f} s')
+        factorization_cache.put(key, lu, lu_nbytes(lu))
+    return lu
+
+
+def solve_block(solver, B):
+    """
+    Solves for every column of ``B`` at once.
+
+    Parameters
+    ----------
+    solver: scipy.sparse.linalg.SuperLU, PermutedLU, BlockDiagonalLU or callable
+        A factorization as returned by `factorize`, or any ``solve(b)``
+        callable such as the one returned by ``linalg.factorized``
+    B: numpy.ndarray
+        Right hand sides, shape ``(n, k)``
+
+    Returns
+    -------
+    numpy.ndarray
+        Solutions, shape ``(n, k)``
+    """
+    # linalg.factorized hands back SuperLU.solve when UMFPACK isn't available
+    solver = getattr(solver, '__self__', solver)
+    if isinstance(solver, (linalg.SuperLU, PermutedLU, BlockDiagonalLU)):
+        # SuperLU takes all right hand sides in one (BLAS-3) call, column major
+        return solver.solve(np.asfortranarray(B))
+
+    # generic solve(b) callables (e.g. UMFPACK through linalg.factorized) only
+    # take one right hand side
+    X = np.empty(B.shape, dtype=np.result_type(B.dtype, np.float64), order='F')
+    for i in range(B.shape[1]):
+        X[:, i] = solver(B[:, i])
+    return X
+
+
+def _preconditioner(AtA, preconditioner):
+    if preconditioner is None:
+        return None
+    if preconditioner == 'jacobi':
+        diagonal = AtA.diagonal()
+        inv_diagonal = np.where(diagonal != 0.0, 1.0 / np.where(diagonal != 0.0, diagonal, 1.0), 1.0)
+        return linalg.LinearOperator(AtA.shape, matvec=lambda x: inv_diagonal * x, dtype=AtA.dtype)
+    if preconditioner == 'ilu':
+        ilu = linalg.spilu(AtA.tocsc(), drop_tol=1e-4, fill_factor=10)
+        return linalg.LinearOperator(AtA.shape, matvec=ilu.solve, dtype=AtA.dtype)
+    raise ValueError(f'Unknown preconditioner {preconditioner}')
+
+
+def solve_iterative(A, B, method='cg', preconditioner='jacobi', tol=1e-8, maxiter=None, X0=None, progress=None):
+    """
+    Least-squares solve of ``A X = B`` without factorizing ``A``, for systems
+    whose LU fill-in doesn't fit in memory.
+
+    Parameters
+    ----------
+    A: scipy.sparse matrix
+    B: numpy.ndarray
+        Right hand sides, shape ``(n, k)``
+    method: str
+        ``'cg'``: conjugate gradient on the normal equations ``A^T A X = A^T B``
+        ``'lsqr'``: LSQR on ``A`` directly
+    preconditioner: str or None
+        ``'jacobi'`` (diagonal of ``A^T A``, i.e. column scaling for LSQR),
+        ``'ilu'`` (incomplete LU of ``A^T A``, cg only) or None
+    tol: float
+        Relative tolerance
+    maxiter: int or None
+    X0: numpy.ndarray or None
+        Initial guess, e.g. the previous solution of the same system
+    progress: callable or None
+        Called with ``(columns done, total)`` after every column, may raise
+        to abort the solve
+
+    Returns
+    -------
+    numpy.ndarray, list
+        The solution ``(n, k)`` and one ``(iterations, relative residual)``
+        pair per column
+    """
+    A = A.tocsr()
+    X = np.empty((A.shape[1], B.shape[1]), order='F')
+    stats = []
+
+    if method == 'cg':
+        AtA = (A.T @ A).tocsr()
+        AtB = A.T @ B
+        M = _preconditioner(AtA, preconditioner)
+    elif method == 'lsqr':
+        if preconditioner not in (None, 'jacobi'):
+            raise ValueError(f'lsqr only supports the jacobi preconditioner, not {preconditioner}')
+        # right preconditioning: solve (A D) y = b, x = D y
+        scale = np.ones(A.shape[1])
+        if preconditioner == 'jacobi':
+            column_norms = np.sqrt(np.asarray(A.multiply(A).sum(axis=0)).ravel())
+            scale[column_norms != 0.0] = 1.0 / column_norms[column_norms != 0.0]
+        AD = A @ diags(scale)
+    else:
+        raise ValueError(f'Unknown iterative method {method}')
+
+    for i in range(B.shape[1]):
+        x0 = None if X0 is None else X0[:, i]
+        if method == 'cg':
+            iterations = [0]
+            def count(xk):
+                iterations[0] += 1
+            X[:, i], _ = linalg.cg(AtA, AtB[:, i], x0=x0, maxiter=maxiter, M=M, callback=count, **{_CG_TOL: tol})
+            iterations = iterations[0]
+        else:
+            y0 = None if x0 is None else x0 / scale
+            result = linalg.lsqr(AD, B[:, i], atol=tol, btol=tol, iter_lim=maxiter, x0=y0)
+            X[:, i] = result[0] * scale
+            iterations = result[2]
+
+        b_norm = np.linalg.norm(B[:, i])
+        residual = np.linalg.norm(B[:, i] - A @ X[:, i]) / (b_norm if b_norm > 0.0 else 1.0)
+        stats.append((iterations, residual))
+        if progress is not None:
+            progress(i + 1, B.shape[1])
+    return X, stats
+
+
+def solve_system(data, row, col, shape, B, mode='auto', preconditioner='jacobi', tol=1e-8, maxiter=None,
+                 progress=None, ordering=DEFAULT_ORDERING):
+    """
+    Solves ``A X = B`` for the COO matrix ``A = (data, (row, col))``.
+
+    Parameters
+    ----------
+    data, row, col: numpy.ndarray
+        COO triplets of the matrix
+    shape: tuple
+    B: numpy.ndarray
+        Right hand sides, shape ``(n, k)``
+    mode: str
+        ``'direct'`` (cached LU, see `factorize`), ``'cg'``, ``'lsqr'`` or
+        ``'auto'``, which picks lsqr above `ITERATIVE_MIN_ROWS` rows and direct
+        otherwise
+    preconditioner, tol, maxiter, progress:
+        See `solve_iterative`, a direct solve reports all the columns at once
+    ordering: str
+        Column ordering of the direct solve, see `factorize_blocks`
+
+    Returns
+    -------
+    numpy.ndarray
+        Solutions, shape ``(n, k)``
+    """
+    if mode == 'auto':
+        mode = 'lsqr' if shape[0] > ITERATIVE_MIN_ROWS else 'direct'
+
+    if mode == 'direct':
+        lu = factorize(data, row, col, shape, ordering)
+        start = time.perf_counter()
+        X = solve_block(lu, B)
+        # logged on every solve, the factorization may come from the cache
+        print(f'LU solve of {B.shape[1]} right hand sides: {time.perf_counter() - start:.3f} s, '
+              f'nnz(L+U) {lu_nnz(lu)}')
+        if progress is not None:
+            progress(B.shape[1], B.shape[1])
+        return X
+
+    A = coo_matrix((data, (row, col)), shape=shape)
+    # the last solution per system size is the warm start of the next rebake,
+    # kept in (and evicted from) the factorization cache with its memory
+    warm_start_key = ('warm start', tuple(shape), B.shape[1])
+    X0 = factorization_cache.get(warm_start_key)
+    X, stats = solve_iterative(A, B, method=mode, preconditioner=preconditioner, tol=tol, maxiter=maxiter, X0=X0,
+                               progress=progress)
+    factorization_cache.put(warm_start_key, X, X.nbytes)
+
+    print(f'{mode} ({preconditioner}) on {shape[0]}x{shape[1]}, {A.nnz} nnz, warm start: {X0 is not None}')
+    for i, (iterations, residual) in enumerate(stats):
+        print(f'  dim {i}: {iterations} iterations, relative residual {residual:.3e}')
+    return X
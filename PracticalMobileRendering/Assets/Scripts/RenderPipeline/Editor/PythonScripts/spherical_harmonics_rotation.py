@@ -1,10 +1,55 @@
+import contextlib
+import io
+import os
+import tempfile
+import time
+
 import numpy as np
 from scipy.sparse import coo_matrix, linalg
 #from scipy.special import factorial
-from clr_array_convert import asNetArray
+from bake_profiler import profiler
+try:
+    from clr_array_convert import asNetArray, asNumpyView
+except ImportError:  # imported by bake_worker.py, out of the editor without pythonnet
+    asNetArray = asNumpyView = None
 from numba import njit, prange
 
 from numba import config, njit, threading_layer
+try:
+    from numba import get_thread_id
+except ImportError:  # Numba < 0.57
+    from numba.np.ufunc.parallel import _get_thread_id as get_thread_id
+
+_import_start = time.perf_counter()
+
+# PythonRunner.RunFile execs this file from a string, which leaves Numba no
+# source file to cache the compiled kernels against. In that case the kernels
+# below are only declared (lazily, never compiled) and the entry point at the
+# bottom imports this file as a regular module to run the bake. The module copy
+# compiles every kernel with an explicit signature, writes it to the on-disk
+# cache and stays alive in sys.modules for later bakes.
+_AS_MODULE = __name__ != "main"
+
+# keep Numba's cache out of the Assets folder so Unity doesn't import it
+if _AS_MODULE and not config.CACHE_DIR and os.path.isdir("Library"):
+    config.CACHE_DIR = os.path.abspath(os.path.join("Library", "NumbaCache"))
+
+
+# every kernel declared through jit(), for the startup report
+_kernels = []
+
+
+def jit(signature=None, **options):
+    def decorator(func):
+        if not _AS_MODULE:
+            return njit(nogil=True, **options)(func)
+        if signature is None:
+            kernel = njit(nogil=True, cache=True, **options)(func)
+        else:
+            kernel = njit(signature, nogil=True, cache=True, **options)(func)
+        _kernels.append(kernel)
+        return kernel
+    return decorator
 
 
 lobe_dirs = np.array([
@@ -19,7 +64,7 @@ lobe_dirs = np.array([
 ], dtype=np.float32)
 
 
-@njit(nogil=True)
+@jit()
 def spherical_dir(theta, phi):
     x = np.sin(theta) * np.cos(phi)
     y = np.sin(theta) * np.sin(phi)
@@ -27,7 +72,7 @@ def spherical_dir(theta, phi):
     return x, y, z
 
 
-@njit(nogil=True)
+@jit()
 def spherical_coord(x, y, z):
     norm = np.sqrt(x**2 + y**2 + z**2)
     theta = np.arccos(z/norm)
@@ -35,12 +80,17 @@ def spherical_coord(x, y, z):
     return theta, phi
 
 
-@njit(nogil=True)
+@jit()
 def sh_idx(m, l):
     return l * (l + 1) + m
 
 
-@njit(nogil=True)
+# P, K, sph_harm, eq_Y_l and eq_A_l_hat aren't used by the bake anymore (see
+# sh_eval and eq_Y), they are declared without a signature so that they only
+# compile if something calls them, not at import
+
+
+@jit()
 def P(l, m, x):
     # evaluate an Associated Legendre Polynomial P(l,m,x) at x
     pmm = 1.0;
@@ -72,25 +122,33 @@ def P(l, m, x):
     return pll
 
 
-@njit(nogil=True)
-def factorial(n):
-    if n <= 0:
-        return 1
-    else:
-        t = 1
-        for i in range(1, n + 1):
-            t =  t * i
-        return t
+# highest band (exclusive) the normalization table below is built for
+SH_MAX_BAND = 32
+
+
+def _build_K_table(max_band):
+    # K(l, |m|) stored at sh_idx(m, l), the factorial ratio (l-m)!/(l+m)! is
+    # accumulated as a running product so nothing overflows for high bands
+    K_table = np.zeros(max_band**2)
+    for l in range(max_band):
+        ratio = 1.0
+        for m in range(l + 1):
+            if m > 0:
+                ratio /= (l - m + 1.0) * (l + m)
+            K_table[l * (l + 1) + m] = K_table[l * (l + 1) - m] = np.sqrt((2.0 * l + 1.0) * ratio / (4.0 * np.pi))
+    return K_table
+
 
+_K_table = _build_K_table(SH_MAX_BAND)
 
-@njit(nogil=True)
+
+@jit()
 def K(l, m):
     #  renormalisation constant for SH function
-    temp = ((2.0 * l + 1.0) * factorial(l - m)) / (4.0 * np.pi * factorial(l + m))
-    return np.sqrt(temp)
+    return _K_table[l * (l + 1) + m]
 
 
-@njit(nogil=True)
+@jit()
 def sph_harm(m, l, theta, phi):
     #  return a point sample of a Spherical Harmonic basis function
     #  l is the band, range [0..N]
@@ -106,79 +164,227 @@ def sph_harm(m, l, theta, phi):
         return sqrt2 * K(l, -m) * np.sin(-m * phi) * P(l, -m, np.cos(theta))
 
 
-@njit(nogil=True)
+@jit(["void(float32, float32, int64, float64[::1])", "void(float64, float64, int64, float64[::1])"])
+def sh_eval(theta, phi, band, Y):
+    # all band**2 basis values of one direction in a single sweep: P(m, m) is
+    # built up across m and the recurrence of P() then walks l upwards, so
+    # every Legendre value is computed once and K comes from the table
+    x = np.cos(theta)
+    somx2 = np.sqrt((1.0 - x) * (1.0 + x))
+    sqrt2 = np.sqrt(2.0)
+
+    pmm = 1.0
+    for m in range(band):
+        if m > 0:
+            pmm *= -(2.0 * m - 1.0) * somx2
+        cos_m_phi = np.cos(m * phi)
+        sin_m_phi = np.sin(m * phi)
+
+        plm_2 = 0.0
+        plm_1 = 0.0
+        for l in range(m, band):
+            if l == m:
+                plm = pmm
+            elif l == m + 1:
+                plm = x * (2.0 * m + 1.0) * pmm
+            else:
+                plm = ((2.0 * l - 1.0) * x * plm_1 - (l + m - 1.0) * plm_2) / (l - m)
+            plm_2 = plm_1
+            plm_1 = plm
+
+            center = l * (l + 1)
+            if m == 0:
+                Y[center] = _K_table[center] * plm
+            else:
+                Y[center + m] = sqrt2 * _K_table[center + m] * cos_m_phi * plm
+                Y[center - m] = sqrt2 * _K_table[center - m] * sin_m_phi * plm
+
+
+@jit()
 def eq_D_l(l):
     return np.sqrt(4*np.pi/(2*l+1))
 
 
-@njit(nogil=True)
-def eq_Y_l(l):
+@jit()
+def eq_Y_l(l, dirs):
+    # dirs is a lobe_set() of any band above l, only its first 2l+1 lobes are used
     matrix_size = 2*l+1
-    dirs = lobe_dirs[(l)**2 : (l+1)**2]
-    
-    Y_l = np.zeros([matrix_size, matrix_size])
-    for row in np.arange(0, matrix_size):
+
+    Y_l = np.zeros((matrix_size, matrix_size))
+    Y = np.empty((l+1)**2)
+    for row in range(matrix_size):
         w = dirs[row]
-        for column in np.arange(0, matrix_size):
-            m = column - l
-            Y_l[row][column] = sph_harm(m, l, w[0], w[1])
+        sh_eval(w[0], w[1], l+1, Y)
+        Y_l[row] = Y[l**2 : (l+1)**2]
     return Y_l
 
 
-@njit(nogil=True)
-def eq_Y(N):
-    start_band = 0
-    matrix_size = N**2 - start_band**2
+@jit("float64[:, ::1](int64, float32[:, ::1])")
+def eq_Y(N, dirs):
+    matrix_size = N**2
     Y_l = np.zeros((matrix_size, matrix_size))
 
-    # lobe sharing
-    dirs = lobe_dirs[(N-1)**2 : (N)**2]
-
-    for l in np.arange(start_band, N):
-        diagonal_matrix_offset = l**2 - start_band**2
-        diagonal_matrix_size = 2*l + 1
-        for row in np.arange(0, diagonal_matrix_size):
-            w = dirs[row]
-            for column in np.arange(0, diagonal_matrix_size):
-                m = column - l
-                Y_l[row+diagonal_matrix_offset][column+diagonal_matrix_offset] = sph_harm(m, l, w[0], w[1])
+    # lobe sharing, dirs is lobe_set(N) and lobe `row` is a row of every band
+    # block with 2l+1 > row, so each lobe is evaluated once for all bands
+    Y = np.empty(matrix_size)
+    for row in range(2*N - 1):
+        w = dirs[row]
+        sh_eval(w[0], w[1], N, Y)
+        for l in range((row + 1) // 2, N):
+            diagonal_matrix_offset = l**2
+            Y_l[row+diagonal_matrix_offset, l**2 : (l+1)**2] = Y[l**2 : (l+1)**2]
     return Y_l
 
 
-@njit(nogil=True)
-def eq_Y_R(N, rot):
-    start_band = 0
-    matrix_size = N**2 - start_band**2
+@jit("float64[:, ::1](int64, float32[:, ::1], float32[:, ::1])")
+def eq_Y_R(N, rot, dirs):
+    matrix_size = N**2
     Y_l = np.zeros((matrix_size, matrix_size))
 
-    # lobe sharing
-    dirs = lobe_dirs[(N-1)**2 : (N)**2]
-
-    for l in np.arange(start_band, N):
-        diagonal_matrix_offset = l**2 - start_band**2
-        diagonal_matrix_size = 2*l + 1
-        for row in np.arange(0, diagonal_matrix_size):
-            w = dirs[row]
-            theta, phi = w[0], w[1]
-            x, y, z = spherical_dir(theta, phi)
-            xyz = np.dot(rot, np.array([x, y, z]))
-            theta, phi = spherical_coord(xyz[0], xyz[1], xyz[2])
-            
-            for column in np.arange(0, diagonal_matrix_size):
-                m = column - l
-                Y_l[row+diagonal_matrix_offset][column+diagonal_matrix_offset] = sph_harm(m, l, theta, phi)
+    # lobe sharing, dirs is lobe_set(N)
+    Y = np.empty(matrix_size)
+    for row in range(2*N - 1):
+        w = dirs[row]
+        theta, phi = w[0], w[1]
+        x, y, z = spherical_dir(theta, phi)
+        xyz = np.dot(rot, np.array([x, y, z]))
+        theta, phi = spherical_coord(xyz[0], xyz[1], xyz[2])
+
+        sh_eval(theta, phi, N, Y)
+        for l in range((row + 1) // 2, N):
+            diagonal_matrix_offset = l**2
+            Y_l[row+diagonal_matrix_offset, l**2 : (l+1)**2] = Y[l**2 : (l+1)**2]
     return Y_l
 
 
-@njit(nogil=True)
-def eq_A_l_hat(l):
-    A_hat = np.linalg.inv(eq_Y_l(l))
+@jit()
+def eq_A_l_hat(l, dirs):
+    A_hat = np.linalg.inv(eq_Y_l(l, dirs))
     return A_hat
 
 
-@njit(nogil=True)
-def eq_A_hat(N):
-    A_hat = np.linalg.inv(eq_Y(N))
+@jit("float64[:, :](int64, float32[:, ::1])")
+def eq_A_hat(N, dirs):
+    A_hat = np.linalg.inv(eq_Y(N, dirs))
+    return A_hat
+
+
+# Lobe sets: with lobe sharing a band N basis needs 2N-1 lobe directions, the
+# first 2l+1 of which must keep the band l block of eq_Y well conditioned for
+# every l < N. The hand-picked table above does for the low bands but not past
+# band 5 (a band 6 block is singular), so any band it doesn't cover well gets
+# a generated set instead, cached on disk.
+LOBE_MAX_CONDITION = 50.0
+
+# generated sets, the generator is deterministic so they only change with it
+_LOBE_CACHE_VERSION = 1
+
+_lobe_sets = {}
+
+
+def lobe_conditions(dirs, band):
+    """
+    Condition number of each band block of eq_Y built from the lobe set
+    `dirs`, batched over any leading axes of `dirs`.
+    """
+    dirs = np.asarray(dirs, dtype=np.float64)
+    Y = sh_basis_batch(dirs[..., 0], dirs[..., 1], band)
+    return np.stack([np.linalg.cond(Y[..., :2*l+1, l**2:(l+1)**2]) for l in range(band)], axis=-1)
+
+
+def _random_dirs(rng, shape):
+    # uniformly distributed on the sphere, as (theta, phi)
+    u, v = rng.random(shape), rng.random(shape)
+    return np.stack((np.arccos(1.0 - 2.0 * u), 2.0 * np.pi * v - np.pi), axis=-1)
+
+
+def generate_lobe_dirs(band, seed=0, candidates=256, iterations=400, proposals=32, step=0.3):
+    """
+    Searches 2*band-1 lobe directions minimizing the worst condition number
+    of the eq_Y blocks. The lobes are first picked band by band, the best of
+    `candidates` random ones for each, then refined over `iterations` rounds
+    that try `proposals` random moves of single lobes and keep the best
+    improvement. Deterministic for a given seed. Returns (dirs, condition).
+    """
+    rng = np.random.default_rng(seed)
+
+    dirs = np.zeros((0, 2))
+    for l in range(band):
+        new_dirs = _random_dirs(rng, (candidates, 1 if l == 0 else 2))
+        sets = np.concatenate((np.broadcast_to(dirs, (candidates,) + dirs.shape), new_dirs), axis=1)
+        dirs = sets[np.argmin(lobe_conditions(sets, l + 1)[:, l])]
+
+    condition = lobe_conditions(dirs, band).max()
+    for _ in range(iterations):
+        moved = rng.integers(0, 2*band - 1, proposals)
+        sets = np.repeat(dirs[None], proposals, axis=0)
+        sets[np.arange(proposals), moved] += rng.normal(0.0, step, (proposals, 2))
+        set_conditions = lobe_conditions(sets, band).max(axis=-1)
+        best = np.argmin(set_conditions)
+        if set_conditions[best] < condition:
+            dirs, condition = sets[best], set_conditions[best]
+
+    # fold back into theta in [0, pi], phi in [-pi, pi]
+    x, y, z = spherical_dir(dirs[:, 0], dirs[:, 1])
+    theta, phi = spherical_coord(x, y, z)
+    dirs = np.stack((theta, phi), axis=1).astype(np.float32)
+    return dirs, lobe_conditions(dirs, band).max()
+
+
+def _lobe_cache_dir():
+    if os.environ.get("SH_LOBE_CACHE_DIR"):
+        return os.environ["SH_LOBE_CACHE_DIR"]
+    if os.path.isdir("Library"):
+        return os.path.join("Library", "SHLobeSets")
+    return os.path.join(tempfile.gettempdir(), "sh_lobe_sets")
+
+
+def lobe_set(band):
+    """
+    The (2*band-1, 2) float32 lobe directions (theta, phi) of the band
+    `band` basis: the lobe_dirs table where it is well conditioned, a
+    generated set otherwise.
+    """
+    dirs = _lobe_sets.get(band)
+    if dirs is not None:
+        return dirs
+    if not 1 <= band <= SH_MAX_BAND:
+        raise ValueError(f"no lobe set for band {band}, bands 1 to {SH_MAX_BAND} are supported")
+
+    if band**2 <= len(lobe_dirs):
+        dirs = lobe_dirs[(band-1)**2 : band**2]
+        if lobe_conditions(dirs, band).max() > LOBE_MAX_CONDITION:
+            dirs = None
+
+    if dirs is None:
+        path = os.path.join(_lobe_cache_dir(), "lobe_dirs_v{}_band{}.npy".format(_LOBE_CACHE_VERSION, band))
+        if os.path.isfile(path):
+            dirs = np.load(path)
+        else:
+            with profiler.stage("generate_lobe_dirs", band=band):
+                dirs, condition = generate_lobe_dirs(band)
+            print("generated lobe set for band {}, condition number {:.2f}".format(band, condition))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            np.save(path, dirs)
+
+    dirs = np.ascontiguousarray(dirs, dtype=np.float32)
+    _lobe_sets[band] = dirs
+    return dirs
+
+
+# eq_A_hat only depends on the band, keep one inverse per band instead of
+# rebuilding and inverting eq_Y for every probe
+_A_hat_cache = {}
+
+
+def rzhb_basis(band):
+    # projection matrix into the Rotated Zonal Harmonic Basis, cached per band
+    A_hat = _A_hat_cache.get(band)
+    if A_hat is None:
+        dirs = lobe_set(band)
+        with profiler.stage("eq_A_hat", band=band):
+            A_hat = np.ascontiguousarray(eq_A_hat(band, dirs), dtype=np.float32)
+        _A_hat_cache[band] = A_hat
     return A_hat
 
 
@@ -201,7 +407,7 @@ def print_sh_coeffs(band, coeffs):
         print(linestr)
 
 
-@njit(nogil=True)
+@jit("float32[:, ::1](float32[::1])")
 def build_rotate_matrix(w):
     # TODO: keep it same as c# code for comparison, use more elegant solution in future
     nz = w / np.linalg.norm(w)
@@ -228,28 +434,27 @@ def build_rotate_matrix(w):
     return np.vstack((nx, ny, nz))
 
 
-@njit(nogil=True)
+@jit("float32[::1](float32[::1])")
 def sh_optimal_direction(coeffs):
     return np.array([-coeffs[3], -coeffs[1], coeffs[2]], dtype=np.float32)
 
 
-@njit(nogil=True)
-def sh_rotate(coeffs, band):
+@jit("float32[::1](float32[::1], int64, float32[:, ::1], float32[:, ::1])")
+def sh_rotate(coeffs, band, A_hat, dirs):
     #print("optimal dir ", sh_optimal_direction(coeffs))
     rotation = build_rotate_matrix(sh_optimal_direction(coeffs))
 
-    # project into Rotated Zonal Harmonic Basis
-    A_hat = eq_A_hat(band).astype(np.float32)
+    # project into Rotated Zonal Harmonic Basis, A_hat comes from rzhb_basis(band)
     Z_hat = A_hat.transpose().dot(coeffs)
 
     # rotate in RZHB
-    Y_R = eq_Y_R(band, rotation).astype(np.float32)
+    Y_R = eq_Y_R(band, rotation, dirs).astype(np.float32)
     coeffs_r = Y_R.transpose().dot(Z_hat)
     return coeffs_r;
 
 
-@njit(nogil=True, parallel=True)
-def main(sh_coeffs, sh_band):
+@jit("float32[:, ::1](float32[:, ::1], int64, float32[:, ::1], float32[:, ::1])", parallel=True)
+def rotate_items(sh_coeffs, sh_band, A_hat, dirs):
     sh_coeffs_prime = np.empty_like(sh_coeffs)
 
     items_per_loop = 64
@@ -263,18 +468,415 @@ def main(sh_coeffs, sh_band):
         for i_item in prange(items_per_loop):
             i = i_loop * items_per_loop + i_item
             if (i < num_items):
-                sh_coeffs_prime[i] = sh_rotate(sh_coeffs[i], sh_band)
+                sh_coeffs_prime[i] = sh_rotate(sh_coeffs[i], sh_band, A_hat, dirs)
 
     return sh_coeffs_prime
 
 
-if __name__ == "main":
-    sh_band = _sh_band
-    sh_coeffs = np.array(_sh_coeffs).reshape((-1, sh_band * sh_band))
+@jit(parallel=True)
+def rotate_items_profiled(sh_coeffs, sh_band, A_hat, dirs, thread_items):
+    # rotate_items that also counts the items run by each worker thread
+    sh_coeffs_prime = np.empty_like(sh_coeffs)
+
+    items_per_loop = 64
+    num_items = sh_coeffs.shape[0]
+    num_loops = int(np.ceil(num_items / items_per_loop))
+
+    for i_loop in prange(num_loops):
+        for i_item in prange(items_per_loop):
+            i = i_loop * items_per_loop + i_item
+            if (i < num_items):
+                sh_coeffs_prime[i] = sh_rotate(sh_coeffs[i], sh_band, A_hat, dirs)
+                thread_items[get_thread_id()] += 1
+
+    return sh_coeffs_prime
+
+
+def main(sh_coeffs, sh_band):
+    sh_coeffs = np.ascontiguousarray(sh_coeffs, dtype=np.float32)
+    A_hat = rzhb_basis(sh_band)
+    if not profiler.enabled:
+        return rotate_items(sh_coeffs, sh_band, A_hat, lobe_set(sh_band))
+
+    # sh_rotate is a single compiled kernel, its stages can only be told
+    # apart on the batched path
+    thread_items = np.zeros(config.NUMBA_NUM_THREADS, dtype=np.int64)
+    with profiler.stage("rotate_items (prange)", items=sh_coeffs.shape[0]):
+        sh_coeffs_prime = rotate_items_profiled(sh_coeffs, sh_band, A_hat, lobe_set(sh_band), thread_items)
+    profiler.thread_utilization("rotate_items", thread_items)
+    return sh_coeffs_prime
+
+
+# Batched path: same math as sh_rotate, but every stage runs on stacked arrays
+# of shape (num_items, ...) so the whole probe set is rotated with a handful of
+# vectorized numpy calls instead of one small-matrix round trip per probe.
+
+def sh_basis_batch(theta, phi, band):
+    # array version of sh_eval, the recurrence is run once per (l, m) over
+    # every direction at once
+    x = np.cos(theta).astype(np.float64)
+    somx2 = np.sqrt((1.0 - x) * (1.0 + x))
+    sqrt2 = np.sqrt(2.0)
+
+    Y = np.empty(theta.shape + (band * band,))
+    pmm = np.ones_like(x)
+    for m in range(band):
+        if m > 0:
+            pmm = pmm * (-(2.0 * m - 1.0)) * somx2
+        if m > 0:
+            cos_m_phi = np.cos(m * phi)
+            sin_m_phi = np.sin(m * phi)
+
+        plm_2, plm_1 = None, None
+        for l in range(m, band):
+            if l == m:
+                plm = pmm
+            elif l == m + 1:
+                plm = x * (2.0 * m + 1.0) * pmm
+            else:
+                plm = ((2.0 * l - 1.0) * x * plm_1 - (l + m - 1.0) * plm_2) / (l - m)
+            plm_2, plm_1 = plm_1, plm
+
+            center = l * (l + 1)
+            if m == 0:
+                Y[..., center] = _K_table[center] * plm
+            else:
+                Y[..., center + m] = sqrt2 * _K_table[center + m] * cos_m_phi * plm
+                Y[..., center - m] = sqrt2 * _K_table[center - m] * sin_m_phi * plm
+    return Y
+
+
+def build_rotate_matrix_batch(w):
+    # batched build_rotate_matrix, returns (num_items, 3, 3) frames
+    num_items = w.shape[0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nz = w / np.linalg.norm(w, axis=1, keepdims=True)
+        oz = np.array([0.0, 0.0, 1.0], dtype=np.float32)
+        nx = np.cross(oz, nz)
+        ny = np.cross(nz, nx)
+        nx = nx / np.linalg.norm(nx, axis=1, keepdims=True)
+        ny = ny / np.linalg.norm(ny, axis=1, keepdims=True)
+
+    frames = np.stack((nx, ny, nz), axis=1).astype(np.float32)
+    frames[nz[:, 2] >= 0.999] = np.eye(3, dtype=np.float32)
+    frames[nz[:, 2] <= -0.999] = np.diag(np.array([1.0, -1.0, -1.0], dtype=np.float32))
+    return frames.reshape((num_items, 3, 3))
+
+
+def sh_optimal_direction_batch(sh_coeffs):
+    return np.stack((-sh_coeffs[:, 3], -sh_coeffs[:, 1], sh_coeffs[:, 2]), axis=1).astype(np.float32)
 
-    sh_coeffs_prime = main(sh_coeffs, sh_band)
 
-    _output = asNetArray(sh_coeffs_prime.reshape((-1)).astype(np.float64))
+def sh_rotate_batch(sh_coeffs, band, A_hat):
+    with profiler.stage("build_rotate_matrix"):
+        rotation = build_rotate_matrix_batch(sh_optimal_direction_batch(sh_coeffs))
+
+    # project into Rotated Zonal Harmonic Basis
+    with profiler.stage("project (A_hat)"):
+        Z_hat = sh_coeffs.dot(A_hat)
+
+    # rotate the shared lobe directions of every item into its own frame
+    with profiler.stage("eq_Y_R"):
+        dirs = lobe_set(band)
+        lobes = np.stack(spherical_dir(dirs[:, 0], dirs[:, 1]), axis=1).astype(np.float32)
+        lobes_r = np.einsum('nij,kj->nki', rotation, lobes)
+        theta, phi = spherical_coord(lobes_r[..., 0], lobes_r[..., 1], lobes_r[..., 2])
+        Y = sh_basis_batch(theta, phi, band).astype(np.float32)
+
+    # rotate in RZHB, Y_R is block diagonal so each band is an independent
+    # (2l+1)x(2l+1) batched product
+    with profiler.stage("rotate (Y_R dot)"):
+        coeffs_r = np.empty_like(sh_coeffs)
+        for l in range(band):
+            begin, end = l**2, (l+1)**2
+            Y_R_l = Y[:, :2*l+1, begin:end]
+            coeffs_r[:, begin:end] = np.einsum('nrc,nr->nc', Y_R_l, Z_hat[:, begin:end])
+    return coeffs_r
+
+
+def unique_probes(sh_coeffs, quantization=None):
+    """
+    Unique rows of `sh_coeffs`, and for every row the index of its unique
+    row. With `quantization`, rows that round to the same multiples of it
+    count as identical and the first of them stands for the group.
+    """
+    keys = sh_coeffs if quantization is None else np.round(sh_coeffs / quantization)
+    # + 0.0 folds -0.0 into 0.0, the rows are compared as raw bytes below
+    keys = np.ascontiguousarray(keys + 0.0)
+    rows = keys.view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1]))).reshape(-1)
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    return sh_coeffs[first], inverse.reshape(-1)
+
+
+def main_batched(sh_coeffs, sh_band, items_per_chunk=65536, dedup=False, quantization=None, progress=None):
+    if dedup:
+        # baked grids have long runs of identical probes (occluded, sky only,
+        # empty space...), rotate each distinct one once and scatter back
+        with profiler.stage("dedup"):
+            unique, inverse = unique_probes(sh_coeffs, quantization)
+        print("dedup: {} -> {} unique probes ({:.2f}x)".format(
+            sh_coeffs.shape[0], unique.shape[0], sh_coeffs.shape[0] / max(unique.shape[0], 1)))
+        return main_batched(unique, sh_band, items_per_chunk, progress=progress)[inverse]
+
+    # chunking only bounds the size of the per-item temporaries
+    sh_coeffs_prime = np.empty_like(sh_coeffs)
+    A_hat = rzhb_basis(sh_band)
+
+    num_items = sh_coeffs.shape[0]
+    print("num items", num_items)
+
+    for begin in range(0, num_items, items_per_chunk):
+        end = min(begin + items_per_chunk, num_items)
+        sh_coeffs_prime[begin:end] = sh_rotate_batch(sh_coeffs[begin:end], sh_band, A_hat)
+        if progress is not None:
+            # (items done, total), may raise to abort the bake
+            progress(end, num_items)
+    return sh_coeffs_prime
+
+
+# band -> (row digests, quantization, output) of the previous bake, for
+# main_incremental
+_rebake_state = {}
+
+
+def row_digests(sh_coeffs):
+    """
+    64-bit FNV-1a style digest of every row of `sh_coeffs`, over the raw
+    bits of its coefficients.
+    """
+    words = np.ascontiguousarray(sh_coeffs).view(np.uint32 if sh_coeffs.itemsize == 4 else np.uint64)
+    digests = np.full(words.shape[0], 0xcbf29ce484222325, dtype=np.uint64)
+    prime = np.uint64(0x100000001b3)
+    for j in range(words.shape[1]):
+        digests ^= words[:, j]
+        digests *= prime
+    return digests
+
+
+def main_incremental(sh_coeffs, sh_band, **options):
+    """
+    main_batched that only rotates the rows that changed since the previous
+    call with the same band, splicing them into the previous output. The
+    returned array is kept for the next call and must not be modified.
+
+    A change of the dedup quantization (see unique_probes) rebakes every
+    row: the previous output holds rows approximated with the old one.
+    """
+    with profiler.stage("row_digests"):
+        digests = row_digests(sh_coeffs)
+    # only a quantized dedup changes the results
+    quantization = options.get("quantization") if options.get("dedup") else None
+    previous = _rebake_state.get(sh_band)
+    if previous is None or previous[0].shape != digests.shape or previous[1] != quantization:
+        output = main_batched(sh_coeffs, sh_band, **options)
+        print("rebake: full, {} probes".format(digests.shape[0]))
+    else:
+        previous_digests, _, output = previous
+        changed = np.flatnonzero(digests != previous_digests)
+        if changed.size > 0:
+            output[changed] = main_batched(sh_coeffs[changed], sh_band, **options)
+        print("rebake: {} of {} probes changed".format(changed.size, digests.shape[0]))
+    _rebake_state[sh_band] = (digests, quantization, output)
+    return output
+
+
+def clear_rebake_state():
+    _rebake_state.clear()
+
+
+def _probe_file_layout(path, sh_band, dtype):
+    # byte offset of the first probe, dtype and probe count of a .npy file or
+    # of a raw file of band**2-wide rows
+    if path.endswith('.npy'):
+        with open(path, 'rb') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if fortran_order or np.prod(shape[1:]) != sh_band * sh_band:
+                raise ValueError(f"{path} doesn't hold C ordered band {sh_band} probes")
+            return f.tell(), dtype, shape[0]
+
+    dtype = np.dtype(dtype)
+    row_bytes = sh_band * sh_band * dtype.itemsize
+    num_bytes = os.path.getsize(path)
+    if num_bytes % row_bytes:
+        raise ValueError(f"{path} doesn't hold a whole number of band {sh_band} {dtype} probes")
+    return 0, dtype, num_bytes // row_bytes
+
+
+def rotate_file(input_path, output_path, sh_band, items_per_chunk=65536, dtype=np.float32):
+    """
+    Streaming version of main_batched: probes are read from `input_path` and
+    the rotated probes written to `output_path` one chunk at a time, through
+    a memory map of just that chunk, so the peak RSS depends on
+    `items_per_chunk` and not on the number of probes.
+
+    Both files are either .npy files or raw C ordered (num_items, band**2)
+    arrays of `dtype`. The output has the dtype of the input and is
+    overwritten.
+    """
+    input_offset, dtype, num_items = _probe_file_layout(input_path, sh_band, dtype)
+    num_coeffs = sh_band * sh_band
+    row_bytes = num_coeffs * dtype.itemsize
+
+    if output_path.endswith('.npy'):
+        # writes the header and sizes the file
+        header = np.lib.format.open_memmap(output_path, mode='w+', dtype=dtype, shape=(num_items, num_coeffs))
+        output_offset = header.offset
+        del header
+    else:
+        with open(output_path, 'wb') as f:
+            f.truncate(num_items * row_bytes)
+        output_offset = 0
+
+    A_hat = rzhb_basis(sh_band)
+    print("num items", num_items)
+
+    for begin in range(0, num_items, items_per_chunk):
+        end = min(begin + items_per_chunk, num_items)
+        shape = (end - begin, num_coeffs)
+        sh_coeffs = np.memmap(input_path, dtype=dtype, mode='r', offset=input_offset + begin * row_bytes, shape=shape)
+        sh_coeffs_prime = np.memmap(output_path, dtype=dtype, mode='r+', offset=output_offset + begin * row_bytes, shape=shape)
+        sh_coeffs_prime[:] = sh_rotate_batch(np.array(sh_coeffs), sh_band, A_hat)
+        sh_coeffs_prime.flush()
+        # unmap the chunk so its pages don't stay resident
+        del sh_coeffs, sh_coeffs_prime
+    return num_items
+
+
+def measure_throughput(sh_coeffs, sh_band, repeat=3):
+    # compare the batched path against the per-item prange path, both are
+    # called once beforehand so JIT compilation is not part of the timings
+    results = {}
+    for name, func in (("prange", main), ("batched", main_batched)):
+        output = func(sh_coeffs, sh_band)
+        best = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(sh_coeffs, sh_band)
+            best = min(best, time.perf_counter() - start)
+        results[name] = output
+        print("{:>8}: {:10.4f} s  {:12.0f} items/s".format(name, best, sh_coeffs.shape[0] / best))
+
+    print("max abs diff", np.nanmax(np.abs(results["prange"] - results["batched"])))
+    return results
+
+
+def warm_up(bands=(3,), prange=False):
+    """
+    Compile (or load from the on-disk cache) everything a bake of the given
+    bands touches, by rotating a handful of dummy probes through the batched
+    path, and the per-item prange path (`main`, profiled or not) too if
+    `prange` is set.
+    Can be called ahead of time, e.g. when the editor starts, so the first
+    bake doesn't pay for it. Returns the elapsed time in seconds.
+    """
+    start = time.perf_counter()
+    for band in np.atleast_1d(bands):
+        band = int(band)
+        dummy = np.ones((2, band * band), dtype=np.float32)
+        # the dummy rotations' prints would be mistaken for the bake's
+        with contextlib.redirect_stdout(io.StringIO()):
+            main_batched(dummy, band)
+        if prange:
+            main(dummy, band)
+            # and the variant a profiled bake runs
+            rotate_items_profiled(dummy, band, rzhb_basis(band), lobe_set(band),
+                                  np.zeros(config.NUMBA_NUM_THREADS, dtype=np.int64))
+    return time.perf_counter() - start
+
+
+def _cache_stats():
+    return (sum(sum(kernel.stats.cache_hits.values()) for kernel in _kernels),
+            sum(sum(kernel.stats.cache_misses.values()) for kernel in _kernels))
+
+
+# what the previous startup_report covered: the import is only paid by the
+# first bake of the session, and the kernels' cache stats are cumulative
+_reported = {"import_time": 0.0, "cache_stats": (0, 0)}
+
+
+def startup_report(warm_up_time, compute_time):
+    """
+    Prints the JIT time and cache use of the bake being reported, i.e. since
+    the previous report.
+    """
+    cache_hits, cache_misses = _cache_stats()
+    reported_hits, reported_misses = _reported["cache_stats"]
+    cache_hits, cache_misses = cache_hits - reported_hits, cache_misses - reported_misses
+    compile_time = _import_time - _reported["import_time"] + warm_up_time
+    _reported["import_time"] = _import_time
+    _reported["cache_stats"] = _cache_stats()
+
+    print("jit: {:.3f} s ({:d} loaded from cache, {:d} compiled), compute: {:.3f} s".format(
+        compile_time, cache_hits, cache_misses, compute_time))
+    return {"compile": compile_time, "compute": compute_time,
+            "cache_hits": cache_hits, "cache_misses": cache_misses}
+
+
+if _AS_MODULE:
+    _source_mtime = os.path.getmtime(__file__)
+_import_time = time.perf_counter() - _import_start
+
+
+if __name__ == "main" and globals().get('_use_worker'):
+    # _use_worker hands the bake to the out-of-process bake worker and returns
+    # straight away: _output_buffer (if given) is filled in and _on_done(job)
+    # called from the worker's reader thread once it completes, _on_progress
+    # (done, total) as it goes. The running job is left in _bake_job.
+    from bake_worker_client import bake_worker, deliver
+    _bake_job = deliver(bake_worker.rotate_sh(_sh_coeffs, _sh_band,
+                                              dedup=globals().get('_sh_dedup', False),
+                                              quantization=globals().get('_sh_dedup_quantization'),
+                                              on_progress=globals().get('_on_progress')),
+                        out=globals().get('_output_buffer'), dtype=np.float64,
+                        on_done=globals().get('_on_done'))
+
+elif __name__ == "main":
+    import importlib
+    import spherical_harmonics_rotation as kernels
+    if kernels._source_mtime != os.path.getmtime(kernels.__file__):
+        kernels = importlib.reload(kernels)
+
+    sh_band = _sh_band
+    # _sh_prange runs the per-item prange kernel (main) instead of the batched
+    # path, e.g. to profile the thread pool: its per-thread item counts are
+    # only recorded there
+    use_prange = globals().get('_sh_prange', False)
+    warm_up_time = kernels.warm_up(sh_band, prange=use_prange)
+
+    # opt-in stage timings and Chrome trace: _profile (or BAKE_PROFILE), _profile_trace
+    with profiler.session(globals().get('_profile'), globals().get('_profile_trace')):
+        compute_start = time.perf_counter()
+
+        if globals().get('_sh_coeffs_path'):
+            # streaming mode: probes are read from _sh_coeffs_path and the result
+            # written to _output_path (.npy or raw arrays), chunk by chunk
+            kernels.rotate_file(_sh_coeffs_path, _output_path, sh_band)
+            kernels.startup_report(warm_up_time, time.perf_counter() - compute_start)
+        else:
+            # the coefficients are read in place from the pinned .NET array
+            with asNumpyView(_sh_coeffs) as sh_coeffs:
+                sh_coeffs = sh_coeffs.reshape((-1, sh_band * sh_band))
+                if use_prange:
+                    sh_coeffs_prime = kernels.main(sh_coeffs, sh_band)
+                else:
+                    # optional: _sh_dedup, _sh_dedup_quantization (see unique_probes),
+                    # _sh_incremental=False to re-rotate every probe
+                    rotate = kernels.main_incremental if globals().get('_sh_incremental', True) else kernels.main_batched
+                    sh_coeffs_prime = rotate(sh_coeffs, sh_band,
+                                             dedup=globals().get('_sh_dedup', False),
+                                             quantization=globals().get('_sh_dedup_quantization'))
+                kernels.startup_report(warm_up_time, time.perf_counter() - compute_start)
+
+            # converted to double while being written into _output; the caller
+            # may pass a preallocated _output_buffer to be written to instead.
+            # _output itself is only ever written, so a scope reused for the
+            # next bake doesn't make it overwrite this result
+            _output = asNetArray(sh_coeffs_prime.reshape((-1)), dtype=np.float64,
+                                 out=globals().get('_output_buffer'))
 
     #print("Threading layer chosen: %s" % threading_layer())
     #main.parallel_diagnostics(level=4)
\ No newline at end of file
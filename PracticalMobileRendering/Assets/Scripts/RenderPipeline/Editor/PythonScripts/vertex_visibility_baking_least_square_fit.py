@@ -1,26 +1,41 @@
-import numpy as np
-from scipy.sparse import coo_matrix, linalg
-from clr_array_convert import asNetArray
+from clr_array_convert import asNetArray, asNumpyView
+from sparse_solver import solve_system
 
 from UnityEngine import Debug
 from System.Collections.Generic import List
 
 
-data = np.array(_data)
-row = np.array(_row)
-col = np.array(_col)
-
-A = coo_matrix((data, (row, col)), shape=(_row_size, _col_size))
-solve = linalg.factorized(A)
-
-B = np.array(_B)
-x = np.zeros_like(B)
-
 stride = _row_size
 dimensions = _dim
 
-for i in range(dimensions):
-    begin, end = i * stride, (i + 1) * stride
-    x[begin : end] = solve(B[begin : end])
-
-_X = asNetArray(x)
+if globals().get('_use_worker'):
+    # hands the solve to the out-of-process bake worker and returns straight
+    # away: _X_buffer (if given) is filled in and _on_done(job) called from the
+    # worker's reader thread once it completes. The running job is left in
+    # _bake_job.
+    from bake_worker_client import bake_worker, deliver
+    _bake_job = deliver(bake_worker.least_squares(_data, _row, _col, (_row_size, _col_size), _B,
+                                                  mode=globals().get('_solver_mode', 'auto'),
+                                                  tol=globals().get('_solver_tolerance', 1e-8),
+                                                  ordering=globals().get('_solver_ordering', 'COLAMD'),
+                                                  on_progress=globals().get('_on_progress')),
+                        out=globals().get('_X_buffer'), on_done=globals().get('_on_done'))
+else:
+    # the inputs are read in place from the pinned .NET arrays, nothing that is
+    # kept past the with block (factorization cache, warm start) references them
+    with asNumpyView(_data) as data, asNumpyView(_row) as row, asNumpyView(_col) as col, asNumpyView(_B) as B:
+        # _B holds the dimensions back to back, solve them as the columns of one
+        # (row_size, dim) block
+        B = B.reshape((dimensions, stride)).T
+
+        # optional: _solver_mode ('auto', 'direct', 'cg', 'lsqr'), _solver_tolerance,
+        # _solver_ordering (see sparse_solver.ORDERINGS, or 'auto')
+        x = solve_system(data, row, col, (_row_size, _col_size), B,
+                         mode=globals().get('_solver_mode', 'auto'),
+                         tol=globals().get('_solver_tolerance', 1e-8),
+                         ordering=globals().get('_solver_ordering', 'COLAMD'))
+
+    # written straight into _X_buffer if the caller passes one, _X itself is
+    # only ever written so that a reused scope can't feed it back to the next
+    # bake
+    _X = asNetArray(x.T.reshape(-1), out=globals().get('_X_buffer'))
\ No newline at end of file
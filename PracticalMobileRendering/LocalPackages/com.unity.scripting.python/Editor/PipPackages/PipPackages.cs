@@ -120,6 +120,9 @@ static int CompileRequirements(string requirementsFile, string pythonInterpreter
                 args.Add($"\"{compiledRequirementsPath}\"");
                 // Only take packages in our site-packages, don't pick up the ones installed on the system.
                 args.Add($"\"{Path.GetFullPath(PythonSettings.kSitePackagesRelativePath)}\"");
+                // The stamp left after the sync is computed from the user's requirements, see PackagesUpToDate.
+                args.Add("--source-requirements");
+                args.Add($"\"{Path.GetFullPath(requirementsFile)}\"");
 
                 using (var process = PythonRunner.SpawnPythonProcess(args, redirectOutput:true))
                 {
@@ -153,12 +156,45 @@ static int CompileRequirements(string requirementsFile, string pythonInterpreter
             }
         }
 
+        /// <summary>
+        /// Returns true if the last sync of update_packages.py was made from the same
+        /// requirements file and the site-packages haven't changed since, in which
+        /// case neither compiling the requirements nor syncing them would change
+        /// anything. Checked in-process, without starting the pip-tools subprocesses.
+        /// </summary>
+        static bool PackagesUpToDate(string requirementsFile)
+        {
+            PythonRunner.EnsureInitialized();
+            using (Py.GIL())
+            {
+                try
+                {
+                    dynamic util = Py.Import("importlib.util");
+                    dynamic spec = util.spec_from_file_location("update_packages", updatePackagesScript);
+                    dynamic updatePackages = util.module_from_spec(spec);
+                    spec.loader.exec_module(updatePackages);
+                    return (bool)updatePackages.is_up_to_date(Path.GetFullPath(requirementsFile),
+                                                              Path.GetFullPath(PythonSettings.kSitePackagesRelativePath));
+                }
+                catch (PythonException e)
+                {
+                    // sync as usual, the script will tell what's wrong
+                    Debug.LogWarning($"Could not check whether the pip packages are up to date: {e.Message}");
+                    return false;
+                }
+            }
+        }
+
         internal static string UpdatePackages(string requirementsFile,
                                               string pythonInterpreter = PythonSettings.kDefaultPython)
         {
             PythonRunner.EnsureInitialized();
             using (Py.GIL())
             {
+                if (PackagesUpToDate(requirementsFile))
+                {
+                    return string.Empty;
+                }
                 // As piptools sync is made to work only with requirements that have been
                 // gemerated by piptools compile, use their workflow: compile the
                 // user-supplied requirements, which may or may not contain dependents.
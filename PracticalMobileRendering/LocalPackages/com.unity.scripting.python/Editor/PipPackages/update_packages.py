@@ -1,31 +1,185 @@
 import argparse
-from pip._internal.commands import create_command
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-# Depending on the version of pip/pip-tools this has a different name.
-try:
-    from pip._internal.utils.misc import get_installed_distributions
-    get_installed_dists = get_installed_distributions
-except ImportError:
-    from piptools.scripts.sync import _get_installed_distributions
-    get_installed_dists = _get_installed_distributions
+_start = time.perf_counter()
 
-from piptools import sync
-from piptools._compat.pip_compat import parse_requirements
+# Written into the site-packages once they are in sync with a requirements
+# file, see compute_stamp. PipPackages.UpdatePackages checks it (is_up_to_date)
+# before compiling the requirements.
+STAMP_FILE = ".update_packages.stamp"
 
-def main(requirements):
+def site_packages_state(site_path):
+    """ Names and modification times of the distribution metadata in `site_path`,
+        which change whenever a package is installed, upgraded or removed.
+    """
+    if not os.path.isdir(site_path):
+        return ""
+    entries = []
+    with os.scandir(site_path) as it:
+        for entry in it:
+            if entry.name.endswith((".dist-info", ".egg-info", ".egg-link", ".pth")):
+                entries.append("{} {}".format(entry.name, entry.stat().st_mtime_ns))
+    return "\n".join(sorted(entries))
+
+def compute_stamp(requirement_file, site_path):
+    """ Hash of the requirements file content, the interpreter and the
+        site-packages state: when it matches the stamp left by the last sync
+        there is nothing to do.
+    """
+    digest = hashlib.sha256()
+    with open(requirement_file, "rb") as f:
+        digest.update(f.read())
+    digest.update(b"\0" + sys.version.encode())
+    digest.update(b"\0" + site_packages_state(site_path).encode())
+    return digest.hexdigest()
+
+def read_stamp(site_path):
+    try:
+        with open(os.path.join(site_path, STAMP_FILE)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def write_stamp(site_path, stamp):
+    with open(os.path.join(site_path, STAMP_FILE), "w") as f:
+        f.write(stamp)
+
+def is_up_to_date(requirement_file, site_path):
+    """ True if the last sync was made from this `requirement_file` (the
+        user's, not the compiled one) and `site_path` hasn't changed since.
+    """
+    return read_stamp(site_path) == compute_stamp(requirement_file, site_path)
+
+def default_wheel_cache():
+    # Library survives editor restarts (Temp doesn't) and isn't imported by Unity
+    if os.path.isdir("Library"):
+        return os.path.abspath(os.path.join("Library", "PipWheelCache"))
+    return os.path.join(tempfile.gettempdir(), "unity-pip-wheel-cache")
+
+def _packaging():
+    # imported when wheels are looked up only, like pip
+    try:
+        from packaging import tags, utils
+    except ImportError:
+        from pip._vendor.packaging import tags, utils
+    return tags, utils
+
+def compatible_wheels(wheel_cache):
+    """ (name, version) of the wheels in `wheel_cache` this interpreter can
+        install, i.e. with a Python/ABI/platform tag it supports.
+    """
+    tags, utils = _packaging()
+    supported = set(tags.sys_tags())
+    wheels = []
+    for filename in os.listdir(wheel_cache):
+        if not filename.endswith(".whl"):
+            continue
+        try:
+            name, version, _, wheel_tags = utils.parse_wheel_filename(filename)
+        except utils.InvalidWheelFilename:
+            continue
+        if not wheel_tags.isdisjoint(supported):
+            wheels.append((utils.canonicalize_name(name), version))
+    return wheels
+
+def _has_wheel(requirement, wheels):
+    name = _packaging()[1].canonicalize_name(requirement.name)
+    return any(wheel_name == name and requirement.specifier.contains(str(version), prereleases=True)
+               for wheel_name, version in wheels)
+
+def build_wheels(requirements, wheel_cache, jobs):
+    """ Downloads or builds the wheels of the pinned `requirements` missing from
+        `wheel_cache`, `jobs` at a time. Returns True if every requirement has
+        a wheel in the cache that this interpreter can install.
+    """
+    os.makedirs(wheel_cache, exist_ok=True)
+
+    cacheable = [req for req in requirements
+                 if not req.editable and req.req is not None and getattr(req, "is_pinned", False)]
+    wheels = compatible_wheels(wheel_cache)
+    missing = [req for req in cacheable if not _has_wheel(req.req, wheels)]
+
+    def build(req):
+        command = [sys.executable, "-m", "pip", "wheel", "--no-deps",
+                   "--wheel-dir", wheel_cache, "--find-links", wheel_cache, str(req.req)]
+        return subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              universal_newlines=True)
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        for req, result in zip(missing, pool.map(build, missing)):
+            if result.returncode != 0:
+                # pip install gets another go at it, from the index
+                print("Could not cache a wheel for {}:\n{}".format(req.req, result.stdout))
+
+    # --no-index only if pip can find every wheel it needs in the cache
+    wheels = compatible_wheels(wheel_cache)
+    return len(cacheable) == len(requirements) and all(_has_wheel(req.req, wheels) for req in cacheable)
+
+def sync_packages(requirement_file, site_path, wheel_cache, jobs):
     """ Get installed pip packages, compare them to the passed packages `requirements` file,
         install missing packages, uninstall packages not needed anymore
-    """    
+
+        Returns the number of installed and uninstalled packages.
+    """
+    # pip is only imported when there is something to do, importing it is a
+    # good part of the cost of a run
+    from pip._internal.commands import create_command
+
+    # Depending on the version of pip/pip-tools this has a different name.
+    try:
+        from pip._internal.utils.misc import get_installed_distributions
+        get_installed_dists = get_installed_distributions
+    except ImportError:
+        from piptools.scripts.sync import _get_installed_distributions
+        get_installed_dists = _get_installed_distributions
+
+    from piptools import sync
+    from piptools._compat.pip_compat import parse_requirements
+
     install_command = create_command("install")
     options, _ = install_command.parse_args([])
     session = install_command._build_session(options)
     finder = install_command._build_package_finder(options=options, session=session)
 
-    requirements = parse_requirements(args.requirement_file, finder=finder, session=session)
-    
-    installed_dists = get_installed_dists(paths=[args.site_path])
+    requirements = parse_requirements(requirement_file, finder=finder, session=session)
+
+    installed_dists = get_installed_dists(paths=[site_path])
     to_install, to_uninstall = sync.diff(requirements, installed_dists)
-    sync.sync(to_install, to_uninstall)
+
+    install_flags = []
+    if to_install:
+        # fetch or build the wheels in parallel, pip then installs them from
+        # the local cache without going back to the index
+        install_flags = ["--find-links", wheel_cache]
+        if build_wheels(to_install, wheel_cache, jobs):
+            install_flags.append("--no-index")
+
+    sync.sync(to_install, to_uninstall, install_flags=install_flags)
+    return len(to_install), len(to_uninstall)
+
+def main(args):
+    # stamped with the requirements the compiled ones were generated from, so
+    # that the next startup can skip compiling them too
+    source = args.source_requirements or args.requirement_file
+    if not args.force and is_up_to_date(source, args.site_path):
+        # what piptools prints, which LoadPipRequirements doesn't report
+        print("Everything up-to-date")
+        return
+
+    sync_start = time.perf_counter()
+    installed, uninstalled = sync_packages(args.requirement_file, args.site_path, args.wheel_cache, args.jobs)
+    # the stamp covers the site-packages as left by the sync
+    write_stamp(args.site_path, compute_stamp(source, args.site_path))
+
+    end = time.perf_counter()
+    print("pip packages synced: {} installed, {} uninstalled in {:.2f} s (startup {:.2f} s)".format(
+        installed, uninstalled, end - sync_start, end - _start))
 
 
 if __name__ == '__main__':
@@ -33,7 +187,13 @@ if __name__ == '__main__':
     parser.add_argument('requirement_file', help='requirements.txt file')
     # Don't pick up the system pacakges, only the ones in *our* site packages
     parser.add_argument('site_path', help='path to the isolated site-packages')
+    parser.add_argument('--wheel-cache', default=default_wheel_cache(),
+                        help='directory of the wheels packages are installed from')
+    parser.add_argument('--jobs', type=int, default=min(8, os.cpu_count() or 1),
+                        help='wheels downloaded or built in parallel')
+    parser.add_argument('--source-requirements',
+                        help='requirements.txt requirement_file was compiled from, stamped instead of it')
+    parser.add_argument('--force', action='store_true', help='sync even if the stamp matches')
     args = parser.parse_args()
 
     main(args)
-
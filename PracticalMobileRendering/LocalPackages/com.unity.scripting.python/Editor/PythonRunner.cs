@@ -148,21 +148,28 @@ public static void RunString(string pythonCodeToExecute, string scopeName = null
             EnsureInitialized();
             using (Py.GIL())
             {
-                // Clean up the string.
-                dynamic inspect = Py.Import("inspect");
-                string code = inspect.cleandoc(pythonCodeToExecute);
-
-                if (string.IsNullOrEmpty(scopeName))
-                {
-                    PythonEngine.Exec(code);
-                }
-                else
+                try
                 {
-                    using (PyModule scope = Py.CreateScope())
+                    // Clean up the string.
+                    dynamic inspect = Py.Import("inspect");
+                    string code = inspect.cleandoc(pythonCodeToExecute);
+
+                    if (string.IsNullOrEmpty(scopeName))
                     {
-                        scope.Set("__name__", scopeName);
-                        scope.Exec(code);
+                        PythonEngine.Exec(code);
                     }
+                    else
+                    {
+                        using (PyModule scope = Py.CreateScope())
+                        {
+                            scope.Set("__name__", scopeName);
+                            scope.Exec(code);
+                        }
+                    }
+                }
+                finally
+                {
+                    FlushStdout();
                 }
             }
         }
@@ -192,19 +199,26 @@ public static void RunFile(string pythonFileToExecute, string scopeName = null)
 
             using (Py.GIL())
             {
-                if (string.IsNullOrEmpty(scopeName))
-                {
-                    PythonEngine.Exec(string.Format("exec(open('{0}').read())", pythonFileToExecute));
-                }
-                else
+                try
                 {
-                    using (PyModule scope = Py.CreateScope())
+                    if (string.IsNullOrEmpty(scopeName))
+                    {
+                        PythonEngine.Exec(string.Format("exec(open('{0}').read())", pythonFileToExecute));
+                    }
+                    else
                     {
-                        scope.Set("__name__", scopeName);
-                        scope.Set("__file__", pythonFileToExecute);
-                        scope.Exec(string.Format("exec(open('{0}').read())", pythonFileToExecute));
+                        using (PyModule scope = Py.CreateScope())
+                        {
+                            scope.Set("__name__", scopeName);
+                            scope.Set("__file__", pythonFileToExecute);
+                            scope.Exec(string.Format("exec(open('{0}').read())", pythonFileToExecute));
+                        }
                     }
                 }
+                finally
+                {
+                    FlushStdout();
+                }
             }
         }
 
@@ -262,10 +276,66 @@ internal static void RedirectStdout()
                 redirect_stdout.redirect_stdout();
                 PythonEngine.AddShutdownHandler(UndoRedirectStdout);
             }
+            EditorApplication.update -= FlushPendingStdout;
+            EditorApplication.update += FlushPendingStdout;
+        }
+
+        // Set from any thread by the Python stdout redirection when output is
+        // left in its buffer, which is then flushed on the next editor update.
+        static volatile bool s_stdoutFlushPending;
+
+        /// <summary>
+        /// Asks for the buffered Python output to be forwarded to the console
+        /// from the main thread, on the next editor update.
+        ///
+        /// Used by unity_python.common.redirecting_stdout, thread-safe.
+        /// </summary>
+        public static void RequestStdoutFlush()
+        {
+            s_stdoutFlushPending = true;
+        }
+
+        static void FlushPendingStdout()
+        {
+            // only take the GIL when there is something to flush
+            if (!s_stdoutFlushPending || !IsInitialized)
+            {
+                return;
+            }
+            s_stdoutFlushPending = false;
+            using (Py.GIL())
+            {
+                try
+                {
+                    dynamic redirect_stdout = Py.Import("unity_python.common.redirecting_stdout");
+                    redirect_stdout.flush_pending();
+                }
+                catch (PythonException e)
+                {
+                    UnityEngine.Debug.LogException(e);
+                }
+            }
+        }
+
+        // Forwards everything the script printed before RunString/RunFile
+        // returns, the redirection otherwise only forwards whole lines now and
+        // then. Called on the main thread, with the GIL.
+        static void FlushStdout()
+        {
+            try
+            {
+                dynamic redirect_stdout = Py.Import("unity_python.common.redirecting_stdout");
+                redirect_stdout.flush();
+            }
+            catch (PythonException e)
+            {
+                UnityEngine.Debug.LogException(e);
+            }
         }
 
         internal static void UndoRedirectStdout()
         {
+            EditorApplication.update -= FlushPendingStdout;
             if (!IsInitialized)
             {
                 return;
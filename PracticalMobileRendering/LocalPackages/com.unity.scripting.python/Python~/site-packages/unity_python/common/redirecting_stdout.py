@@ -1,8 +1,25 @@
+import atexit
 import sys
+import threading
+import time
 import UnityEditor
 
 _orig_stdout = None
 
+# Output is forwarded to C# in batches of whole lines: writes are buffered until
+# FLUSH_INTERVAL seconds went by since the last forward or MAX_BUFFER_SIZE
+# characters are waiting, then sent in one call, by the writing thread only if
+# it is the main thread (the console window can't be touched from any other).
+# Whatever is left in the buffer (the last batch, output of other threads, the
+# count of suppressed lines) is forwarded from the main thread on the next
+# editor update, see flush_pending, and PythonRunner flushes the rest at the
+# end of every RunString/RunFile. Past MAX_CHARS_PER_SECOND the remaining lines
+# of the second are dropped and replaced by a count, so a script printing in a
+# tight loop can't stall the editor.
+FLUSH_INTERVAL = 0.1
+MAX_BUFFER_SIZE = 64 * 1024
+MAX_CHARS_PER_SECOND = 256 * 1024
+
 class FakeStdout(object):
     def __init__(self, write_method, flush_method):
         super().__init__()
@@ -11,12 +28,13 @@ class FakeStdout(object):
 
     def write(self, msg):
         self.write_method(msg)
-    
+
     def flush(self):
         self.flush_method()
 
 class Logger(object):
-    def __init__(self):
+    def __init__(self, flush_interval = FLUSH_INTERVAL, max_buffer_size = MAX_BUFFER_SIZE,
+                 max_chars_per_second = MAX_CHARS_PER_SECOND):
         try:
             import clr
             clr.AddReference("System")
@@ -25,26 +43,135 @@ class Logger(object):
         except ModuleNotFoundError:
             self.terminal = sys.stdout
         self.log = UnityEditor.Scripting.Python.PythonConsoleWindow.AddToOutput
+        # thread-safe, only sets a flag checked by the editor update
+        self.request_flush = UnityEditor.Scripting.Python.PythonRunner.RequestStdoutFlush
+
+        self.flush_interval = flush_interval
+        self.max_buffer_size = max_buffer_size
+        self.max_chars_per_second = max_chars_per_second
+
+        # written to from any thread
+        self._lock = threading.RLock()
+        self._buffer = []
+        self._buffer_size = 0
+        self._last_flush = time.monotonic()
+        self._last_write = self._last_flush
+        self._flush_requested = False
+
+        self._window_start = self._last_flush
+        self._window_chars = 0
+        self._suppressed_lines = 0
+        self._suppressed_chars = 0
 
     def write(self, message):
+        if not message:
+            return
+        with self._lock:
+            self._buffer.append(message)
+            self._buffer_size += len(message)
+            self._last_write = time.monotonic()
+            if (threading.current_thread() is threading.main_thread()
+                    and (self._buffer_size >= self.max_buffer_size
+                         or self._last_write - self._last_flush >= self.flush_interval)):
+                self._flush_buffer(whole_lines = True)
+            if self._buffer or self._suppressed_lines:
+                self._request_flush()
+
+    def flush(self):
+        with self._lock:
+            if threading.current_thread() is threading.main_thread():
+                self._flush_buffer(summarize = True)
+            elif self._buffer or self._suppressed_lines:
+                self._request_flush()
         try:
-            self.terminal.write(message)
+            self.terminal.flush()
         except IOError:
             pass
 
-        self.log(message)  
+    def flush_pending(self):
+        """ Forwards what was left in the buffer, called on the main thread
+            by the editor update after request_flush.
+        """
+        with self._lock:
+            self._flush_requested = False
+            # a line still being written is held back, unless nothing was
+            # written to it for a while (e.g. a prompt printed without end of
+            # line)
+            self._flush_buffer(whole_lines = time.monotonic() - self._last_write < self.flush_interval)
+            if self._buffer:
+                self._request_flush()
 
-    def flush(self):
+    def _request_flush(self):
+        if not self._flush_requested:
+            self._flush_requested = True
+            self.request_flush()
+
+    def _flush_buffer(self, summarize = False, whole_lines = False):
+        now = time.monotonic()
+        text = "".join(self._buffer)
+        self._buffer = []
+        self._buffer_size = 0
+        self._last_flush = now
+        if whole_lines:
+            end = text.rfind("\n") + 1
+            if end < len(text):
+                self._buffer.append(text[end:])
+                self._buffer_size = len(text) - end
+                text = text[:end]
+
+        summary = ""
+        if now - self._window_start >= 1.0:
+            self._window_start = now
+            self._window_chars = 0
+            summarize = True
+        if summarize and self._suppressed_lines:
+            summary = "[{} lines ({} characters) of output suppressed, over {} characters per second]\n".format(
+                self._suppressed_lines, self._suppressed_chars, self.max_chars_per_second)
+            self._suppressed_lines = 0
+            self._suppressed_chars = 0
+
+        allowed = self.max_chars_per_second - self._window_chars
+        if len(text) > allowed:
+            # only whole lines go out
+            cut = text.rfind("\n", 0, max(allowed, 0)) + 1
+            dropped = text[cut:]
+            self._suppressed_lines += dropped.count("\n") + (not dropped.endswith("\n"))
+            self._suppressed_chars += len(dropped)
+            text = text[:cut]
+        if self._suppressed_lines:
+            # report them once the rate window is over, even if nothing else
+            # is printed: the editor updates until then check again
+            self._request_flush()
+        self._window_chars += len(text)
+
+        if summary or text:
+            self._forward(summary + text)
+
+    def _forward(self, text):
         try:
-            self.terminal.flush()
+            self.terminal.write(text)
         except IOError:
             pass
 
+        self.log(text)
+
+def flush_pending():
+    if isinstance(sys.stdout, Logger):
+        sys.stdout.flush_pending()
+
+def flush():
+    if isinstance(sys.stdout, Logger):
+        sys.stdout.flush()
+
 def undo_redirection():
     global _orig_stdout
+    if isinstance(sys.stdout, Logger):
+        sys.stdout.flush()
+        atexit.unregister(sys.stdout.flush)
     sys.stdout = _orig_stdout
-    
+
 def redirect_stdout():
     global _orig_stdout
     _orig_stdout = sys.stdout
-    sys.stdout = Logger()
\ No newline at end of file
+    sys.stdout = Logger()
+    atexit.register(sys.stdout.flush)
@@ -13,14 +13,21 @@ What the example window does is it shows the available cameras in the scene and
 updates the list automatically as new cameras are added.  When the user selects
 a camera in the PySide view and clicks "Use Camera", Unity switches to using
 that camera in the Scene View.
+
+The list is a CameraListModel keyed by instance ID: hierarchy changes only mark
+it dirty, and once per editor update the model is diffed against the scene so
+that only the added, removed and renamed cameras reach the view.
 """
 
+import itertools
 import logging
+import operator
 import os
 import sys
+import time
 import traceback
 
-from scheduling import exec_on_main_thread, exec_on_main_thread_async
+from scheduling import exec_on_main_thread, exec_on_main_thread_async, process_jobs
 
 # This is the C# System.dll not the Python sys module.
 import System
@@ -40,18 +47,126 @@ except ModuleNotFoundError:
 _PYSIDE_UI = None
 _qApp = None
 
+### Model class
+class CameraListModel(QtCore.QAbstractListModel):
+    """
+    List model of cameras keyed by the instance ID of their GameObject.
+
+    apply() diffs a new snapshot against the current rows and only emits the
+    removed, inserted and renamed rows, so the view keeps its selection and
+    scroll position, and the Qt side of a refresh costs in proportion to what
+    changed instead of to the number of cameras.
+    """
+    InstanceIDRole = QtCore.Qt.UserRole
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._ids = []    # row -> instance ID
+        self._rows = {}   # instance ID -> row, None until rebuilt by _row()
+        self._names = {}  # instance ID -> name
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self._ids)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self._ids):
+            return None
+        instance_id = self._ids[index.row()]
+        if role == QtCore.Qt.DisplayRole:
+            return self._names[instance_id]
+        if role == self.InstanceIDRole:
+            return instance_id
+        return None
+
+    def diff(self, names):
+        """
+        Compares `names`, a {instance ID: name} snapshot, to the model and
+        returns the ({instance ID: name} inserted, {instance ID} removed,
+        {instance ID: name} renamed) changes.
+        """
+        if names == self._names:
+            return {}, set(), {}
+
+        # set operations on the dict views and map() run in C, no Python
+        # loop over every camera
+        removed = self._names.keys() - names.keys()
+        inserted = {instance_id: names[instance_id] for instance_id in names.keys() - self._names.keys()}
+        kept = list(names.keys() & self._names.keys())
+        renamed = {instance_id: names[instance_id] for instance_id in itertools.compress(
+            kept, map(operator.ne, map(names.__getitem__, kept), map(self._names.__getitem__, kept)))}
+        return inserted, removed, renamed
+
+    def apply(self, names):
+        """
+        Updates the model to the `names` snapshot. Returns the number of
+        (inserted, removed, renamed) rows.
+        """
+        inserted, removed, renamed = self.diff(names)
+        self.apply_changes(inserted, removed, renamed)
+        return len(inserted), len(removed), len(renamed)
+
+    def apply_changes(self, inserted, removed, renamed):
+        """
+        Removes, inserts and renames rows, only emitting the matching model
+        signals.
+        """
+        if removed:
+            self._remove_rows(sorted((self._row(instance_id) for instance_id in removed), reverse=True))
+            for instance_id in removed:
+                del self._names[instance_id]
+
+        if inserted:
+            first = len(self._ids)
+            self.beginInsertRows(QtCore.QModelIndex(), first, first + len(inserted) - 1)
+            for instance_id, name in inserted.items():
+                if self._rows is not None:
+                    self._rows[instance_id] = len(self._ids)
+                self._ids.append(instance_id)
+                self._names[instance_id] = name
+            self.endInsertRows()
+
+        for instance_id, name in renamed.items():
+            self._names[instance_id] = name
+            index = self.index(self._row(instance_id))
+            self.dataChanged.emit(index, index, [QtCore.Qt.DisplayRole])
+
+    def _row(self, instance_id):
+        # removing rows moves the ones below them, the lookup is rebuilt
+        # (in one pass in C) when next needed rather than patched row by row
+        if self._rows is None:
+            self._rows = dict(zip(self._ids, range(len(self._ids))))
+        return self._rows[instance_id]
+
+    def _remove_rows(self, rows):
+        # rows in descending order, removed as contiguous ranges from the
+        # bottom up so the rows still to remove don't move
+        last = first = rows[0]
+        for row in rows[1:] + [None]:
+            if row is not None and row == first - 1:
+                first = row
+                continue
+            self.beginRemoveRows(QtCore.QModelIndex(), first, last)
+            del self._ids[first:last + 1]
+            self.endRemoveRows()
+            last = first = row
+        self._rows = None
+
+
 ### UI class
 class PySideTestUI():
     # If we use slots we need to include weakref support
-    __slots__ = [ '_dialog', '__weakref__' ]
+    __slots__ = [ '_dialog', '_model', '_refresh_pending', '__weakref__' ]
 
     def __init__(self):
         self._dialog = None
+        self._model = CameraListModel()
+        self._refresh_pending = False
 
         try:
             # Create the dialog from our .ui file
             ui_path = os.path.join(os.path.dirname(__file__), 'PySideExample.ui')
             self._dialog = self.load_ui_widget(ui_path.replace("\\", "/"))
+            self._dialog.listView.setModel(self._model)
 
             # Set up our data.
             self.populate_camera_list()
@@ -71,36 +186,49 @@ class PySideTestUI():
     @exec_on_main_thread
     def populate_camera_list(self):
         """
-        Populates the list of cameras by asking Unity for all the cameras.
+        Brings the list of cameras up to date by asking Unity for all the
+        cameras, only the differences are applied to the list.
         """
-        cameras = [x.name for x in UnityEngine.Camera.allCameras]
+        self._refresh_pending = False
+        cameras = {x.gameObject.GetInstanceID(): x.name for x in UnityEngine.Camera.allCameras}
+        inserted, removed, renamed = self._model.apply(cameras)
 
-        # Populate the list
-        list_widget = self._dialog.listWidget
-        list_widget.clear()
-        for cam in cameras:
-            list_widget.addItem(cam)
+        if inserted or removed or renamed:
+            log("Cameras list updated: {} added, {} removed, {} renamed".format(inserted, removed, renamed))
 
-        log("Cameras list successfully populated")
+    def request_refresh(self):
+        """
+        Marks the list as out of date, it is refreshed on the next editor
+        update however many hierarchy changes happen until then.
+        """
+        self._refresh_pending = True
+
+    def refresh_if_pending(self):
+        if self._refresh_pending:
+            self.populate_camera_list()
 
     @exec_on_main_thread
     def use_camera(self):
         if not self._dialog:
             return
-        # Get the selected camera name
-        selected_items = self._dialog.listWidget.selectedItems()
-        if len(selected_items) != 1:
+        # Get the selected camera
+        selected_indexes = self._dialog.listView.selectionModel().selectedIndexes()
+        if len(selected_indexes) != 1:
             return
 
+        instance_id = selected_indexes[0].data(CameraListModel.InstanceIDRole)
         try:
-            camera = UnityEngine.GameObject.Find('{}'.format(selected_items[0].text()))
+            camera = UnityEditor.EditorUtility.InstanceIDToObject(instance_id)
+            if camera is None:
+                # destroyed since the last refresh
+                return
 
             # Apply camera selection
             self.select_camera(camera)
 
             UnityEditor.EditorApplication.ExecuteMenuItem('GameObject/Align View to Selected')
         except:
-            log('Got an exception trying to use the camera:{}'.format(selected_items[0].text()), logging.ERROR, traceback.format_exc())
+            log('Got an exception trying to use the camera:{}'.format(selected_indexes[0].data()), logging.ERROR, traceback.format_exc())
             raise
 
     def load_ui_widget(self, uifilename, parent=None):
@@ -168,7 +296,59 @@ def create_or_reinitialize():
 def update_camera_list():
     if not _PYSIDE_UI:
         return
-    _PYSIDE_UI.populate_camera_list()
+    # hierarchyChanged fires many times per frame while editing, refreshes are
+    # coalesced into the next on_update
+    _PYSIDE_UI.request_refresh()
 
 def on_update():
+    # runs the jobs queued for the main thread (exec_on_main_thread_async,
+    # submit_on_main_thread...) within this update's budget, see process_jobs
+    process_jobs()
+    if _PYSIDE_UI:
+        _PYSIDE_UI.refresh_if_pending()
     QtWidgets.QApplication.processEvents()
+
+def benchmark_refresh(scene_sizes=(1000, 10000, 100000), change_counts=(0, 1, 10, 100, 1000), repeat=5):
+    """
+    Prints what a CameraListModel refresh costs for scenes of `scene_sizes`
+    cameras of which `change_counts` were replaced: diffing the snapshot
+    against the model, applying the changes to the model (the part the
+    view reacts to), and for comparison a full reset of the model, which is
+    the least clearing and refilling the list costs. Synthetic instance IDs
+    are used, Unity isn't queried.
+    """
+    print("{:>10} {:>10} {:>12} {:>12} {:>12}".format("cameras", "changes", "diff ms", "apply ms", "reset ms"))
+    for scene_size in scene_sizes:
+        scene = {instance_id: "Camera {}".format(instance_id) for instance_id in range(scene_size)}
+        for change_count in change_counts:
+            if change_count > scene_size:
+                continue
+            # replace change_count cameras spread over the scene by new ones
+            changed = dict(scene)
+            for instance_id in range(0, scene_size, scene_size // max(change_count, 1))[:change_count]:
+                del changed[instance_id]
+                changed[scene_size + instance_id] = "Camera {}".format(scene_size + instance_id)
+
+            diff_time = apply_time = reset_time = float("inf")
+            for _ in range(repeat):
+                model = CameraListModel()
+                model.apply(scene)
+                model._row(0)
+
+                start = time.perf_counter()
+                changes = model.diff(changed)
+                diff_time = min(diff_time, time.perf_counter() - start)
+
+                start = time.perf_counter()
+                model.apply_changes(*changes)
+                apply_time = min(apply_time, time.perf_counter() - start)
+
+                start = time.perf_counter()
+                model.beginResetModel()
+                model._ids, model._rows, model._names = [], None, {}
+                model.endResetModel()
+                model.apply_changes(changed, set(), {})
+                reset_time = min(reset_time, time.perf_counter() - start)
+
+            print("{:>10} {:>10} {:>12.3f} {:>12.3f} {:>12.3f}".format(
+                scene_size, change_count, diff_time * 1e3, apply_time * 1e3, reset_time * 1e3))
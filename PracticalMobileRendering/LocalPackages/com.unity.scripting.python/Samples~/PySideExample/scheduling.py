@@ -1,26 +1,88 @@
+import asyncio
+import concurrent.futures
+import functools
+import itertools
 import logging
 import numbers
 import queue
 import sys
 import threading
 import time
+from concurrent.futures import Executor, Future
 
 # When processing jobs, we give clients this much time (in seconds) to respond
 # within the same processing interval or wait for the next editor update.
 process_jobs_max_batch_time = 1 / 90
 
+# Unless process_jobs is given a batch time, the budget of an editor update is
+# this share of the measured interval between updates, capped by
+# process_jobs_max_batch_time, so a slow editor frame isn't made slower.
+process_jobs_budget_fraction = 0.5
+
+# A job deferred to the next update this many times runs regardless of the
+# budget, so long jobs still make progress.
+process_jobs_max_deferrals = 8
+
+# Weight of the latest sample in the moving averages of job durations and of
+# the interval between updates.
+_EMA_WEIGHT = 0.2
+
+# Priority lanes, jobs of a lower lane always run first. Long running work
+# (bake callbacks...) should use LANE_BACKGROUND so it can't starve UI refreshes.
+LANE_UI = 0
+LANE_DEFAULT = 1
+LANE_BACKGROUND = 2
+_LANE_NAMES = {LANE_UI: "ui", LANE_DEFAULT: "default", LANE_BACKGROUND: "background"}
+
+_job_sequence = itertools.count()
+# lane -> sequence number of the last job created on it, see
+# submit_many_on_main_thread
+_lane_sequences = {}
+_sequence_lock = threading.Lock()
+
+class _Job(object):
+    """
+    A queued job: ordered by lane, then by submission order.
+    """
+    __slots__ = ["run", "lane", "key", "sequence", "enqueued", "deferrals"]
+
+    def __init__(self, run, lane = LANE_DEFAULT, key = None):
+        self.run = run
+        self.lane = lane
+        # jobs with the same key share the duration estimate used for budgeting
+        self.key = key if key is not None else _job_key(run)
+        with _sequence_lock:
+            self.sequence = next(_job_sequence)
+            _lane_sequences[lane] = self.sequence
+        self.enqueued = time.perf_counter()
+        self.deferrals = 0
+
+    def __lt__(self, other):
+        return (self.lane, self.sequence) < (other.lane, other.sequence)
+
+def _job_key(f):
+    if isinstance(f, functools.partial):
+        f = f.func
+    return getattr(f, "__qualname__", type(f).__name__)
+
+class _JobQueue(queue.PriorityQueue):
+    # plain callables put by older code go to the default lane
+    def _put(self, item):
+        if not isinstance(item, _Job):
+            item = _Job(item)
+        super()._put(item)
 
 # This is the job queue. Add to it via jobs.put or call_on_main_thread.
 # The main thread calls process_jobs every editor update (or every 2s in
 # standalone mode) to process all outstanding jobs and then wait a bit longer
 # for some fast replies.
-_jobs = queue.Queue()
+_jobs = _JobQueue()
 
 #####################
 # This connection delays some dispatching until the main thread gets to it.
 # That's necessary for accessing some Unity objects. It's also a source of deadlocks,
 # so we try to avoid delays if possible.
-def call_on_main_thread(f, wait_for_result = True):
+def call_on_main_thread(f, wait_for_result = True, lane = LANE_DEFAULT):
     """
     Call a function on the main thread.
     
@@ -29,6 +91,8 @@ def call_on_main_thread(f, wait_for_result = True):
 
     If wait_for_result is False, then None is returned and exceptions will not 
     be raised
+
+    `lane` is the priority lane of the job, see LANE_UI.
     """
     if wait_for_result and threading.current_thread() is threading.main_thread():
         # Only execute (and block) if we're on the main thread and want to get 
@@ -55,7 +119,7 @@ def call_on_main_thread(f, wait_for_result = True):
             condition.notify()
 
     with condition:
-        _jobs.put(job)
+        _jobs.put(_Job(job, lane, _job_key(f)))
 
         if wait_for_result:
             condition.wait()
@@ -66,7 +130,218 @@ def call_on_main_thread(f, wait_for_result = True):
         
         return None
 
-def process_jobs(batch_time = process_jobs_max_batch_time):
+#####################
+# Batched dispatch. Calls submitted with submit_on_main_thread or
+# submit_many_on_main_thread are appended to the pending batch of their lane
+# and only the first call of a batch puts a job in the queue: everything 
+# submitted to that lane before the main thread gets to the job is run back to
+# back by it, in submission order. A batch only takes new calls as long as its
+# job is the last one put on the lane, the calls submitted after another job
+# (call_on_main_thread...) start a new batch and run after that job.
+_pending_batches = {}
+_pending_calls_lock = threading.Lock()
+
+class _Batch(object):
+    __slots__ = ["lane", "calls", "sequence"]
+
+    def __init__(self, lane, calls):
+        self.lane = lane
+        self.calls = calls
+        self.sequence = None
+
+    def run(self):
+        with _pending_calls_lock:
+            if _pending_batches.get(self.lane) is self:
+                del _pending_batches[self.lane]
+            calls, self.calls = self.calls, []
+        for future, f in calls:
+            _run_call(future, f)
+
+def _run_call(future, f):
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        future.set_result(f())
+    except BaseException as e:
+        future.set_exception(e)
+
+def submit_many_on_main_thread(functions, lane = LANE_DEFAULT):
+    """
+    Call every function of `functions` (callables taking no argument) on the
+    main thread, as a single job, and return a list of 
+    concurrent.futures.Future holding their results or exceptions.
+
+    Submissions from several threads made before the main thread processes 
+    the job coalesce into the same batch, so many small calls cost one queue
+    entry and one wake-up of the main thread. Use concurrent.futures.wait or
+    Future.result to wait for them, never from the main thread itself: it 
+    would block the thread that runs them. When called from the main thread
+    the functions are run immediately.
+
+    `lane` is the priority lane of the batch, see LANE_UI.
+    """
+    calls = [(Future(), f) for f in functions]
+    if threading.current_thread() is threading.main_thread():
+        for future, f in calls:
+            _run_call(future, f)
+        return [future for future, _ in calls]
+
+    if not calls:
+        return []
+    with _pending_calls_lock:
+        batch = _pending_batches.get(lane)
+        if batch is not None and batch.sequence == _lane_sequences.get(lane):
+            batch.calls.extend(calls)
+            job = None
+        else:
+            batch = _Batch(lane, calls)
+            job = _Job(batch.run, lane, "batch")
+            batch.sequence = job.sequence
+            _pending_batches[lane] = batch
+    if job is not None:
+        _jobs.put(job)
+    return [future for future, _ in calls]
+
+def submit_on_main_thread(f, *args, **kwargs):
+    """
+    Call f(*args, **kwargs) on the main thread and return a
+    concurrent.futures.Future of its result. See submit_many_on_main_thread.
+    """
+    return submit_many_on_main_thread([lambda: f(*args, **kwargs)])[0]
+
+class MainThreadExecutor(Executor):
+    """
+    concurrent.futures.Executor running the submitted calls on the main 
+    thread, batched through submit_many_on_main_thread. Worker threads can
+    keep many main thread calls in flight and collect their results and
+    exceptions from the futures, e.g. with asyncio:
+
+        result = await loop.run_in_executor(executor, f, arg)
+    """
+    def __init__(self, lane = LANE_DEFAULT):
+        self.lane = lane
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._futures = set()
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+        # Outside of the lock: on the main thread fn runs right here and may
+        # submit to this executor itself.
+        future = submit_many_on_main_thread([lambda: fn(*args, **kwargs)], self.lane)[0]
+        with self._lock:
+            if not future.done():
+                self._futures.add(future)
+        # Also outside: the callback runs immediately if the future completed
+        # in the meantime, and takes the lock.
+        future.add_done_callback(self._discard)
+        return future
+
+    def _discard(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def shutdown(self, wait = True, *, cancel_futures = False):
+        with self._lock:
+            self._shutdown = True
+            futures = list(self._futures)
+
+        if cancel_futures:
+            for future in futures:
+                future.cancel()
+        if wait:
+            if threading.current_thread() is threading.main_thread():
+                # nobody else is going to run them; with a batch time, so
+                # these back to back calls don't count as editor updates in
+                # the measured update interval
+                while not all(future.done() for future in futures):
+                    process_jobs(process_jobs_max_batch_time)
+            else:
+                concurrent.futures.wait(futures)
+
+async def run_on_main_thread(f, *args, **kwargs):
+    """
+    Awaitable version of call_on_main_thread: returns the result of 
+    f(*args, **kwargs) run on the main thread, or raises its exception, 
+    without blocking the event loop's thread while waiting.
+    """
+    return await asyncio.wrap_future(submit_on_main_thread(f, *args, **kwargs))
+
+#####################
+# Budgeting and metrics, measured by process_jobs.
+_job_durations = {}  # job key -> moving average of its run time
+_update_interval = None  # moving average of the time between editor updates
+_last_update = None
+
+def _moving_average(average, sample):
+    return sample if average is None else average + _EMA_WEIGHT * (sample - average)
+
+class _LaneMetrics(object):
+    __slots__ = ["jobs", "deferrals", "run_time", "total_latency", "max_latency"]
+
+    def __init__(self):
+        self.jobs = 0
+        self.deferrals = 0
+        self.run_time = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+_lane_metrics = {}
+_metrics_start = time.perf_counter()
+
+def job_metrics():
+    """
+    Returns, per lane name: the number of jobs run and deferred, the jobs run
+    per second, the mean and max queue latency (from submission to the start
+    of the job, in seconds) and the mean run time since the last
+    reset_job_metrics, plus the current per-update budget.
+    """
+    elapsed = max(time.perf_counter() - _metrics_start, 1e-9)
+    metrics = {}
+    for lane, lane_metrics in sorted(_lane_metrics.items()):
+        jobs = max(lane_metrics.jobs, 1)
+        metrics[_LANE_NAMES.get(lane, str(lane))] = {
+            "jobs": lane_metrics.jobs,
+            "deferrals": lane_metrics.deferrals,
+            "jobs_per_second": lane_metrics.jobs / elapsed,
+            "mean_latency": lane_metrics.total_latency / jobs,
+            "max_latency": lane_metrics.max_latency,
+            "mean_run_time": lane_metrics.run_time / jobs,
+        }
+    metrics["budget"] = _update_budget()
+    return metrics
+
+def reset_job_metrics():
+    global _metrics_start
+    _lane_metrics.clear()
+    _metrics_start = time.perf_counter()
+
+def _update_budget():
+    if _update_interval is None:
+        return process_jobs_max_batch_time
+    return min(process_jobs_max_batch_time, process_jobs_budget_fraction * _update_interval)
+
+def _run_job(job):
+    started = time.perf_counter()
+    try:
+        job.run()
+    except Exception as e:
+        msg = f"An unexpected Exception occured while processing the job {job.run}: {e}"
+        UnityEngine.Debug.LogException(msg)
+        print(msg)
+    finally:
+        run_time = time.perf_counter() - started
+        _job_durations[job.key] = _moving_average(_job_durations.get(job.key), run_time)
+
+        metrics = _lane_metrics.setdefault(job.lane, _LaneMetrics())
+        metrics.jobs += 1
+        metrics.run_time += run_time
+        metrics.total_latency += started - job.enqueued
+        metrics.max_latency = max(metrics.max_latency, started - job.enqueued)
+
+def process_jobs(batch_time = None):
     """
     Call this from the main loop on every editor update.
 
@@ -76,9 +351,26 @@ def process_jobs(batch_time = process_jobs_max_batch_time):
     milisecond, a job with a run time of 10 hours can be processed. The corollary
     is that a batch_time lower that the length of a job can be used to make sure 
     we process only one job.
+
+    Jobs are run lane by lane (see LANE_UI), in submission order within a
+    lane. Without `batch_time`, the budget is process_jobs_budget_fraction of
+    the measured interval between updates, capped by 
+    process_jobs_max_batch_time. A job whose average run time doesn't fit in
+    what's left of the budget is deferred to the next update, unless it's
+    the first job of this one or was already deferred 
+    process_jobs_max_deferrals times. The jobs queued behind it in its lane
+    wait with it, so calls that depend on their order (create, then modify)
+    still run in order; only the lanes after it can go ahead.
     """
+    global _update_interval, _last_update
 
-    if not isinstance(batch_time, numbers.Number):
+    if batch_time is None:
+        now = time.perf_counter()
+        if _last_update is not None:
+            _update_interval = _moving_average(_update_interval, now - _last_update)
+        _last_update = now
+        batch_time = _update_budget()
+    elif not isinstance(batch_time, numbers.Number):
         raise TypeError("'batch_time' argument must be numeric")
     
     # The main thread always holds the GIL. Explicitly yield with a time.sleep
@@ -88,30 +380,46 @@ def process_jobs(batch_time = process_jobs_max_batch_time):
     if _jobs.empty():
         return
 
-    start = time.time()
+    start = time.perf_counter()
     remaining = batch_time
-    while remaining > 0:
-        try:
-            job = _jobs.get(timeout=remaining)
+    ran_any = False
+    held = []
+    blocked_lanes = set()
+    try:
+        while remaining > 0:
             try:
-                job()
-            except Exception as e:
-                msg = f"An unexpected Exception occured while processing the job {job}: {e}"
-                UnityEngine.Debug.LogException(msg)
-                print(msg)
+                job = _jobs.get(timeout=remaining)
+            except queue.Empty:
+                break
+
+            estimate = _job_durations.get(job.key, 0.0)
+            if job.lane in blocked_lanes:
+                # behind a deferred job of its lane
+                held.append(job)
+            elif ran_any and estimate > remaining and job.deferrals < process_jobs_max_deferrals:
+                job.deferrals += 1
+                held.append(job)
+                blocked_lanes.add(job.lane)
+                _lane_metrics.setdefault(job.lane, _LaneMetrics()).deferrals += 1
+            else:
+                _run_job(job)
+                ran_any = True
 
             _jobs.task_done()
-        except queue.Empty:
-            break
-        elapsed = (time.time() - start)
-        remaining = batch_time - elapsed
+            elapsed = (time.perf_counter() - start)
+            remaining = batch_time - elapsed
+    finally:
+        # put back with their sequence numbers, they keep their place in
+        # their lane
+        for job in held:
+            _jobs.put(job)
 
 def process_all_jobs():
     while not _jobs.empty():
-        process_jobs()
+        process_jobs(process_jobs_max_batch_time)
 
 
-def make_exec_on_main_thread_decorator(wait_for_result):
+def make_exec_on_main_thread_decorator(wait_for_result, lane = LANE_DEFAULT):
     def decorator(f):
         """
         Decorator that will queue a job (function) for execution on the main
@@ -124,7 +432,7 @@ def make_exec_on_main_thread_decorator(wait_for_result):
         queueing the job, and exceptions will not propagate.
         """
         def func_wrapper(*args, **kwargs):
-            call_on_main_thread(lambda: f(*args,**kwargs), wait_for_result=wait_for_result)
+            call_on_main_thread(functools.partial(f, *args, **kwargs), wait_for_result=wait_for_result, lane=lane)
         return func_wrapper
     return decorator
 